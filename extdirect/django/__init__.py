@@ -2,6 +2,7 @@
 from extdirect.django.providers import ExtRemotingProvider, ExtPollingProvider
 from extdirect.django.store import ExtDirectStore
 from extdirect.django.crud import ExtDirectCRUD
+from extdirect.django.lookup import ExtDirectLookup
 from extdirect.django.decorators import remoting, polling, crud
 
 
@@ -0,0 +1,148 @@
+"""
+Helpers to cache query results with Django's cache framework.
+
+Every watched model has a version counter in the cache. The counter is
+bumped when an instance is saved or deleted (and by the CRUD actions,
+which also write without sending signals), and it's part of the keys of
+everything cached for that model, so old entries are simply never read
+again.
+"""
+import functools
+import hashlib
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from extdirect.django.codec import dumps
+
+VERSION_KEY = 'extdirect:version:%s'
+
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def _new_version():
+    # Start from the current time, so a counter evicted from the cache
+    # never goes back to a value used before.
+    return int(time.time() * 1000)
+
+
+def version(name):
+    """
+    Return the current value of the version counter `name`.
+    """
+    key = VERSION_KEY % name
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, _new_version(), None)
+        value = cache.get(key)
+    return value
+
+
+def bump_version(name):
+    """
+    Bump the version counter `name` and return its new value.
+    """
+    key = VERSION_KEY % name
+    try:
+        return cache.incr(key)
+    except ValueError:
+        #the counter was evicted (or never set)
+        value = _new_version()
+        cache.set(key, value, None)
+        return value
+
+
+def model_version(model):
+    return version(model_label(model))
+
+
+def bump_model_version(model):
+    return bump_version(model_label(model))
+
+
+_pending = threading.local()
+
+
+def bump_model_version_on_commit(model):
+    """
+    Bump the version of `model` once the current transaction is over,
+    so a concurrent read can't cache the rows it doesn't see yet (see
+    `bump_pending`). Outside of a transaction it's bumped right away.
+    """
+    if transaction.get_connection().in_atomic_block:
+        if not hasattr(_pending, 'names'):
+            _pending.names = set()
+        _pending.names.add(model_label(model))
+    else:
+        bump_model_version(model)
+
+
+def bump_pending(**kw):
+    """
+    Bump the versions deferred by `bump_model_version_on_commit`, unless
+    a transaction is still open. It's also called at the end of every
+    request, after the transaction of ATOMIC_REQUESTS.
+    """
+    if transaction.get_connection().in_atomic_block:
+        return
+    names = getattr(_pending, 'names', None)
+    _pending.names = set()
+    for name in names or ():
+        bump_version(name)
+
+request_finished.connect(bump_pending, dispatch_uid='extdirect-bump-pending')
+
+
+def bump_after(func):
+    """
+    Decorator: call `bump_pending` when `func` returns, i.e. after the
+    transaction of a `transaction.atomic` function under it.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        try:
+            return func(*args, **kw)
+        finally:
+            bump_pending()
+    return wrapper
+
+
+def _bump_sender(sender, **kw):
+    bump_model_version(sender)
+
+
+def watch_model(model):
+    """
+    Bump the version of `model` every time one of its instances is
+    saved or deleted. It's safe to call it several times.
+    """
+    uid = 'extdirect-version-%s' % model_label(model)
+    post_save.connect(_bump_sender, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(_bump_sender, sender=model, weak=False, dispatch_uid=uid)
+
+
+def normalize(value):
+    """
+    Return `value` with its dicts turned into sorted lists of items,
+    so equal values always dump to the same JSON.
+    """
+    if isinstance(value, dict):
+        return sorted([k, normalize(v)] for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    return value
+
+
+def make_key(prefix, model, *parts):
+    """
+    Return a cache key for `model` made of its current version and
+    a hash of `parts`, which must be serializable to JSON.
+    """
+    digest = hashlib.md5(dumps(normalize(parts)).encode('utf-8')).hexdigest()
+    return 'extdirect:%s:%s:%s:%s' % (prefix, model_label(model), model_version(model), digest)
@@ -0,0 +1,168 @@
+"""
+JSON codec for the ExtDirect responses.
+
+`dumps` writes compact JSON with the standard library json module.
+On Python 3 it uses orjson instead when it's installed; orjson doesn't
+support Python 2, so there the standard library is always used. Both
+backends give the same output, except for the floats: the standard
+library writes `1e+16` and `NaN`, orjson `1e16` and `null`.
+
+Values that must reach the client as JavaScript code instead of strings
+(renderers, handlers, listeners...) have to be wrapped in `RawJS`::
+
+    dumps({'renderer': RawJS('Ext.util.Format.usMoney'), 'width': 50})
+    --> {"renderer":Ext.util.Format.usMoney,"width":50}
+
+Big values could be wrapped in `JSONStream`, an iterable of JSON text
+chunks. `iterdumps` writes them chunk by chunk instead of building the
+whole string in memory.
+"""
+import json
+import uuid
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import force_unicode
+from django.utils.functional import Promise
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class RawJS(object):
+    """
+    Wrap JavaScript code to dump it without quotes.
+    """
+
+    def __init__(self, code):
+        self.code = code
+
+    def __eq__(self, other):
+        return isinstance(other, RawJS) and other.code == self.code
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return 'RawJS(%r)' % self.code
+
+
+class JSONStream(object):
+    """
+    A JSON value given as an iterable of text chunks, see `iterdumps`.
+    It can be read only once.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+
+class _Default(object):
+    """
+    The `default` hook for both backends. It handles the Django types
+    (dates, decimals, lazy strings) and swaps every RawJS value for a
+    unique token that `dumps` replaces at the end. JSONStream values
+    are swapped for tokens too.
+    """
+
+    encoder = DjangoJSONEncoder()
+
+    def __init__(self):
+        self.nonce = None
+        self.reset()
+
+    def reset(self):
+        self.raw = []
+        self.streams = []
+
+    def token(self, kind, index):
+        if self.nonce is None:
+            self.nonce = uuid.uuid4().hex
+        return '@@%s-%s-%d@@' % (kind, self.nonce, index)
+
+    def __call__(self, obj):
+        if isinstance(obj, RawJS):
+            token = self.token('rawjs', len(self.raw))
+            self.raw.append((token, obj.code))
+            return token
+        if isinstance(obj, JSONStream):
+            token = self.token('stream', len(self.streams))
+            self.streams.append(('"%s"' % token, obj))
+            return token
+        if isinstance(obj, Promise):
+            return force_unicode(obj)
+        return self.encoder.default(obj)
+
+    def restore(self, text):
+        for token, code in self.raw:
+            text = text.replace('"%s"' % token, code)
+        for token, stream in self.streams:
+            text = text.replace(token, ''.join(stream))
+        return text
+
+    def iterrestore(self, text):
+        for token, code in self.raw:
+            text = text.replace('"%s"' % token, code)
+        #the tokens are in the text in the same order they were made
+        for token, stream in self.streams:
+            head, text = text.split(token, 1)
+            yield head
+            for chunk in stream:
+                yield chunk
+        yield text
+
+
+def _stdlib_dumps(obj, default, indent):
+    if indent is None:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=default)
+    return json.dumps(obj, ensure_ascii=False, indent=indent, default=default)
+
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def _fast_dumps(obj, default):
+        try:
+            return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS).decode('utf-8')
+        except TypeError:
+            #orjson is stricter than the json module (e.g. integers bigger
+            #than 64 bits), let the standard library try it.
+            default.reset()
+            return _stdlib_dumps(obj, default, None)
+else:
+    def _fast_dumps(obj, default):
+        return _stdlib_dumps(obj, default, None)
+
+
+def dumps(obj, indent=None):
+    """
+    Return `obj` as a JSON string.
+
+    The output is compact unless `indent` is given, in which case
+    the standard library is always used.
+    """
+    default = _Default()
+    if indent is None:
+        text = _fast_dumps(obj, default)
+    else:
+        text = _stdlib_dumps(obj, default, indent)
+    return default.restore(text)
+
+
+def iterdumps(obj):
+    """
+    Return `obj` as a JSON string, like `dumps`, or as an iterator of
+    text chunks if it has JSONStream values, which are read lazily.
+    """
+    default = _Default()
+    text = _fast_dumps(obj, default)
+    if not default.streams:
+        return default.restore(text)
+    return default.iterrestore(text)
@@ -1,11 +1,13 @@
-from django.db import transaction
+from django.core.exceptions import ValidationError
+from django.db import transaction, connections, router
 from django.core.serializers import serialize
 from django.utils.encoding import force_unicode
 from django.db.models import fields
-from django.forms.models import ModelFormMetaclass, ModelForm
+from django.forms.models import ModelFormMetaclass, ModelForm, modelform_factory
 
 from extdirect.django.store import ExtDirectStore
-from extdirect.django import extfields
+from extdirect.django import extfields, identity
+from extdirect.django.caching import bump_after, bump_model_version_on_commit
 
 
 def format_form_errors(errors):
@@ -39,6 +41,28 @@ class BaseExtDirectCRUD(object):
     metadata = True     # include metaData
     colModel = False    # include colModel in metaData
 
+    #Create all the records sent at once: they are validated first, then
+    #inserted with `bulk_create` in batches of `bulk_batch_size` when the
+    #primary keys are known (set by the form, or returned by the database
+    #on Django 1.10+ with PostgreSQL). Otherwise, e.g. an AutoField on
+    #Django 1.6, they are saved one by one. See `post_bulk_create`.
+    use_bulk_create = False
+    bulk_batch_size = 500
+
+    #Update all the records sent at once: the objects are read with one
+    #query, only the submitted fields are validated and only the changed
+    #columns are written. See `post_bulk_update`.
+    use_bulk_update = False
+
+    #Delete all the records sent with one `QuerySet.delete()`.
+    #See `post_destroy_many`.
+    use_bulk_destroy = False
+
+    #Run the read and load actions in the provider's thread pool (see
+    #ExtRemotingProvider `parallel`). Only safe when they don't change the
+    #shared store (its `metadata` and `fields` are set by every call).
+    parallel_reads = False
+
     #Messages
     create_success_msg = "Records created"
     create_failure_msg = "There was an error while trying to save some of the records"
@@ -76,20 +100,28 @@ class BaseExtDirectCRUD(object):
         if 'destroy' in self.actions:
             self.reg_destroy(provider, action, login_required, permission)
 
+    #The write actions are never run in the provider's thread pool, and a
+    #batch with one of them is run in the request thread, in the order the
+    #client sent it. The reads are pooled only with `parallel_reads`.
     def reg_create(self, provider, action, login_required, permission):
-        provider.register(self.create, action, 'create', 1, self.isForm, login_required, permission)
+        provider.register(self.create, action, 'create', 1, self.isForm, login_required, permission,
+                          parallel=False)
 
     def reg_read(self, provider, action, login_required, permission):
-        provider.register(self.read, action, 'read', 1, False, login_required, permission)
+        provider.register(self.read, action, 'read', 1, False, login_required, permission,
+                          parallel=self.parallel_reads)
 
     def reg_load(self, provider, action, login_required, permission):
-        provider.register(self.load, action, 'load', 1, False, login_required, permission)
+        provider.register(self.load, action, 'load', 1, False, login_required, permission,
+                          parallel=self.parallel_reads)
 
     def reg_update(self, provider, action, login_required, permission):
-        provider.register(self.update, action, 'update', 1, self.isForm, login_required, permission)
+        provider.register(self.update, action, 'update', 1, self.isForm, login_required, permission,
+                          parallel=False)
 
     def reg_destroy(self, provider, action, login_required, permission):
-        provider.register(self.destroy, action, 'destroy', 1, False, login_required, permission)
+        provider.register(self.destroy, action, 'destroy', 1, False, login_required, permission,
+                          parallel=False)
 
     def direct_store(self):
         return ExtDirectStore(self.model, metadata=self.metadata)
@@ -102,6 +134,12 @@ class BaseExtDirectCRUD(object):
         #You can override this method and extract any optional data from request.
         return None
 
+    def cache_scope(self, request, optional_data):
+        #Used by the result cache of the store (`cache_results`). Return anything
+        #JSON serializable that changes the records but isn't in the request
+        #parameters or in the `query` queryset, e.g. `request.user.pk`.
+        return None
+
     #All the "extract_(action)_data" will depend on how you registered each method.
     def extract_create_data(self, request, sid):
         #It must return a dict object or a list of dicts with the values ready
@@ -147,7 +185,7 @@ class BaseExtDirectCRUD(object):
 
         if self.parse_fk_fields:
             data = self._fk_fields_parser(data)
-        form = self._get_form()(data, request.FILES)
+        form = self._make_form(self._get_form(), request, data)
         if form.is_valid():
             c = form.save()
             self.post_single_create(request, c, optional_data)
@@ -159,11 +197,94 @@ class BaseExtDirectCRUD(object):
     def _get_form(self):
         return self.form
 
+    def _make_form(self, form_class, request, data, instance=None):
+        form = form_class(data, request.FILES, instance=instance)
+        identity.bind(form, getattr(request, 'extdirect_identity_map', None))
+        return form
+
+    def _model_fields(self):
+        #{name: field} of the concrete and many-to-many fields, computed once.
+        if '_fields_by_name' not in self.__dict__:
+            opts = self.model._meta
+            self._fields_by_name = dict((f.name, f) for f in opts.fields + opts.many_to_many)
+        return self._fields_by_name
+
+    def _identity_map(self, records):
+        #The map of the related objects of all the records, read with one
+        #query per related model (see the `identity` module).
+        identity_map = identity.IdentityMap()
+        model_fields = self._model_fields()
+        for data in records:
+            for name, value in data.items():
+                field = model_fields.get(name)
+                if field is None and name[-3:] == '_id':
+                    field = model_fields.get(name[:-3])
+                if field is not None and field.rel is not None:
+                    identity_map.add(field.rel.to, identity.related_pks(value))
+        return identity_map
+
+    def _bulk_create(self, request, records, optional_data):
+        #Returns the created objects and a dict {index: errors} of the
+        #invalid records. Nothing is created if any of them is invalid.
+        form_class = self._get_form()
+        forms = []
+        errors = {}
+        for i, data in enumerate(records):
+            data.pop("id", "")
+            if self.parse_fk_fields:
+                data = self._fk_fields_parser(data)
+            form = self._make_form(form_class, request, data)
+            if form.is_valid():
+                forms.append(form)
+            else:
+                errors[i] = form.errors
+        if errors:
+            return [], errors
+
+        objects = [form.save(commit=False) for form in forms]
+        if self._can_bulk_insert(objects):
+            self.model.objects.bulk_create(objects, batch_size=self.bulk_batch_size)
+        else:
+            for obj in objects:
+                obj.save()
+        for form in forms:
+            form.save_m2m()
+
+        self._written([obj.pk for obj in objects])
+        self.post_bulk_create(request, objects, optional_data)
+        return objects, {}
+
+    def _can_bulk_insert(self, objects):
+        #The primary keys of the objects must be known after bulk_create,
+        #which doesn't support multi-table inheritance. Before Django 1.10
+        #no backend returns the new ids, so only the objects with an
+        #explicit primary key (not an AutoField) are bulk inserted.
+        if self.model._meta.parents:
+            return False
+        if all(obj.pk is not None for obj in objects):
+            return True
+        features = connections[router.db_for_write(self.model)].features
+        return getattr(features, 'can_return_rows_from_bulk_insert', False) \
+            or getattr(features, 'can_return_ids_from_bulk_insert', False)
+
+    def _written(self, ids):
+        #The bulk writes don't send the model signals.
+        backend = getattr(self.store, 'search_backend', None)
+        if backend is not None:
+            backend.update(ids)
+
+    def _requery(self, ids, optional_data):
+        #sorted by the primary key: the store's default sort field is `id`
+        sort = [{self.store.property: self.model._meta.pk.name, self.store.dir: 'DESC'}]
+        return self.store.query(self.model.objects.filter(self.store.query_filter.in_q('pk', ids)),
+                                metadata=False, col_model=False, optional=optional_data,
+                                **{self.store.sort: sort})
+
     def _single_update(self, request, data, optional_data):
         obj = self.model.objects.get(pk=data.pop('id'))
         if self.parse_fk_fields:
             data = self._fk_fields_parser(data)
-        form = self._get_form()(data, request.FILES, instance=obj)
+        form = self._make_form(self._get_form(), request, data, instance=obj)
         if form.is_valid():
             obj = form.save()
             self.post_single_update(request, obj, optional_data)
@@ -172,6 +293,101 @@ class BaseExtDirectCRUD(object):
             print('_single_update FORM ERROR', format_form_errors(form.errors))
             return 0, form.errors
 
+    def _bulk_update(self, request, records, optional_data):
+        #Returns the updated objects and a dict {index: errors} of the
+        #invalid records. Nothing is written if any of them is invalid.
+        ids = [data.pop('id', None) for data in records]
+        instances = {}
+        for i in range(0, len(ids), self.bulk_batch_size):
+            instances.update(self.model.objects.in_bulk(ids[i:i + self.bulk_batch_size]))
+
+        forms = []
+        errors = {}
+        for i, data in enumerate(records):
+            obj = instances.get(self._to_pk(ids[i]))
+            if obj is None:
+                errors[i] = {'id': ['%s matching query does not exist.' % self.model._meta.object_name]}
+                continue
+            if self.parse_fk_fields:
+                data = self._fk_fields_parser(data)
+            form = self._make_form(self._get_update_form(data), request, data, instance=obj)
+            if form.is_valid():
+                forms.append(form)
+            else:
+                errors[i] = form.errors
+        if errors:
+            return [], errors
+
+        groups = {}
+        for form in forms:
+            obj = form.save(commit=False)
+            columns = self._changed_fields(form)
+            for field in columns:
+                setattr(obj, field.attname, field.pre_save(obj, False))
+            if columns:
+                groups.setdefault(tuple(columns), []).append(obj)
+
+        for columns, objs in groups.items():
+            self._write_columns(objs, columns)
+        for form in forms:
+            form.save_m2m()
+
+        objects = [form.instance for form in forms]
+        self._written([obj.pk for obj in objects])
+        self.post_bulk_update(request, objects, optional_data)
+        return objects, {}
+
+    def _to_pk(self, id):
+        #The client may send the ids as strings, `in_bulk` keys are the
+        #Python values.
+        try:
+            return self.model._meta.pk.to_python(id)
+        except ValidationError:
+            return id
+
+    def _get_update_form(self, data):
+        #A form restricted to the submitted fields, cached by field names.
+        form_class = self._get_form()
+        names = tuple(sorted(name for name in data if name in form_class.base_fields))
+        cache = self.__dict__.setdefault('_update_forms', {})
+        if names not in cache:
+            cache[names] = modelform_factory(self.model, form=form_class, fields=names,
+                                             formfield_callback=identity.formfield_callback)
+        return cache[names]
+
+    def _changed_fields(self, form):
+        #The concrete fields changed by the form, and the `auto_now` ones,
+        #inherited fields included (`update` writes them in their table).
+        opts = self.model._meta
+        columns = []
+        for field in opts.concrete_fields:
+            if field.primary_key or getattr(field.rel, 'parent_link', False):
+                continue
+            if field.name in form.changed_data or getattr(field, 'auto_now', False):
+                columns.append(field)
+        return columns
+
+    def _write_columns(self, objs, columns):
+        #`bulk_update` when the Django version has it, otherwise one
+        #UPDATE per distinct set of values.
+        manager = self.model._base_manager
+        if hasattr(manager, 'bulk_update'):
+            manager.bulk_update(objs, [f.name for f in columns], batch_size=self.bulk_batch_size)
+            return
+
+        updates = {}
+        for obj in objs:
+            values = tuple((f.name, getattr(obj, f.attname)) for f in columns)
+            try:
+                updates.setdefault(values, []).append(obj.pk)
+            except TypeError:
+                #unhashable values (e.g. lists), written alone
+                manager.filter(pk=obj.pk).update(**dict(values))
+
+        for values, pks in updates.items():
+            for i in range(0, len(pks), self.bulk_batch_size):
+                manager.filter(pk__in=pks[i:i + self.bulk_batch_size]).update(**dict(values))
+
     # Process of data in order to fix the foreign keys according to how
     # the `extdirect` serializer handles them.
     # {'fk_model': 'FKModel','fk_model_id':1} --> {'fk_model':1, 'fk_model_id': 1}
@@ -206,15 +422,30 @@ class BaseExtDirectCRUD(object):
     def post_single_create(self, request, obj, optional_data=None):
         pass
 
+    def post_bulk_create(self, request, objs, optional_data=None):
+        #Called instead of `post_single_create` when `use_bulk_create` is set.
+        for obj in objs:
+            self.post_single_create(request, obj, optional_data)
+
     def post_update(self, ids, optional_data=None):
         pass
 
     def post_single_update(self, request, obj, optional_data=None):
         pass
 
+    def post_bulk_update(self, request, objs, optional_data=None):
+        #Called instead of `post_single_update` when `use_bulk_update` is set.
+        for obj in objs:
+            self.post_single_update(request, obj, optional_data)
+
     def post_destroy(self, id, optional_data=None):
         pass
 
+    def post_destroy_many(self, ids, optional_data=None):
+        #Called instead of `post_destroy` when `use_bulk_destroy` is set.
+        for id in ids:
+            self.post_destroy(id, optional_data)
+
     def failure(self, msg):
         return {self.store.success: False, self.store.root: [], self.store.total: 0, self.store.message: msg}
 
@@ -239,7 +470,8 @@ class BaseExtDirectCRUD(object):
                 model = tmp_model
 
             class_name = model.__name__ + 'Form'
-            form_class = ModelFormMetaclass(class_name, (ModelForm,), {'Meta': Meta})
+            form_class = ModelFormMetaclass(class_name, (ModelForm,), {
+                'Meta': Meta, 'formfield_callback': identity.formfield_callback})
             return model, form_class
 
         raise GenericViewError('Generic view must be called with either a model or form_class argument.')
@@ -256,6 +488,7 @@ class ExtDirectCRUD(BaseExtDirectCRUD):
     """
 
     #CREATE
+    @bump_after
     @transaction.atomic
     def create(self, request):
         sid = transaction.savepoint()
@@ -266,10 +499,18 @@ class ExtDirectCRUD(BaseExtDirectCRUD):
         if not ok:
             return self.failure(msg)
 
+        request.extdirect_identity_map = self._identity_map(
+            extdirect_data if isinstance(extdirect_data, list) else [extdirect_data])
+
         ids = []
         success = True
         errors = {}
-        if isinstance(extdirect_data, list):
+        bulk = self.use_bulk_create and isinstance(extdirect_data, list)
+        if bulk:
+            objects, errors = self._bulk_create(request, extdirect_data, optional_data)
+            ids = [obj.pk for obj in objects]
+            success = not errors
+        elif isinstance(extdirect_data, list):
             for data in extdirect_data:
                 id, errors = self._single_create(request, data, optional_data)
                 if id:
@@ -287,13 +528,16 @@ class ExtDirectCRUD(BaseExtDirectCRUD):
         try:
             if success:
                 self.post_create(ids, optional_data)
-                res = self.store.query(self.model.objects.filter(pk__in=ids),
-                                       metadata=False, col_model=False, optional=optional_data)
+                bump_model_version_on_commit(self.model)
+                res = self._requery(ids, optional_data)
                 res[self.store.message] = self.create_success_msg
                 return res
             else:
                 transaction.savepoint_rollback(sid)
-                if self.show_form_validation:
+                if self.show_form_validation and bulk:
+                    #errors by record index
+                    err = dict((i, format_form_errors(e)) for i, e in errors.items())
+                elif self.show_form_validation:
                     err = format_form_errors(errors)
                 else:
                     err = self.create_failure_msg
@@ -312,7 +556,8 @@ class ExtDirectCRUD(BaseExtDirectCRUD):
         ok, msg = self.pre_read(extdirect_data, optional_data)
         if ok:
             return self.store.query(qs=self.query(request, optional_data, **extdirect_data),
-                                    fields=fields, optional=optional_data, **extdirect_data)
+                                    fields=fields, optional=optional_data,
+                                    cache_scope=self.cache_scope(request, optional_data), **extdirect_data)
         else:
             return self.failure(msg)
 
@@ -334,6 +579,7 @@ class ExtDirectCRUD(BaseExtDirectCRUD):
             return self.failure(msg)
 
     #UPDATE
+    @bump_after
     @transaction.atomic
     def update(self, request):
         sid = transaction.savepoint()
@@ -344,11 +590,19 @@ class ExtDirectCRUD(BaseExtDirectCRUD):
         if not ok:
             return self.failure(msg)
 
+        request.extdirect_identity_map = self._identity_map(
+            extdirect_data if isinstance(extdirect_data, list) else [extdirect_data])
+
         ids = []
         success = True
         records = extdirect_data
         errors = {}
-        if isinstance(records, list):
+        bulk = self.use_bulk_update and isinstance(records, list)
+        if bulk:
+            objects, errors = self._bulk_update(request, records, optional_data)
+            ids = [obj.pk for obj in objects]
+            success = not errors
+        elif isinstance(records, list):
             #batch update
             for data in records:
                 id, errors = self._single_update(request, data, optional_data)
@@ -369,13 +623,16 @@ class ExtDirectCRUD(BaseExtDirectCRUD):
         try:
             if success:
                 self.post_update(ids, optional_data)
-                res = self.store.query(self.model.objects.filter(pk__in=ids),
-                                       metadata=False, col_model=False, optional=optional_data)
+                bump_model_version_on_commit(self.model)
+                res = self._requery(ids, optional_data)
                 res[self.store.message] = self.update_success_msg
                 return res
             else:
                 transaction.savepoint_rollback(sid)
-                if self.show_form_validation:
+                if self.show_form_validation and bulk:
+                    #errors by record index
+                    err = dict((i, format_form_errors(e)) for i, e in errors.items())
+                elif self.show_form_validation:
                     err = format_form_errors(errors)
                 else:
                     err = self.update_failure_msg
@@ -385,6 +642,7 @@ class ExtDirectCRUD(BaseExtDirectCRUD):
             transaction.savepoint_commit(sid)
 
     #DESTROY
+    @bump_after
     def destroy(self, request):
         ids, optional_data = self.extract_destroy_data(request)
 
@@ -392,15 +650,23 @@ class ExtDirectCRUD(BaseExtDirectCRUD):
         if not ok:
             return self.failure(msg)
 
-        if isinstance(ids, list):
-            cs = self.model.objects.filter(pk__in=ids)
+        if self.use_bulk_destroy and isinstance(ids, list):
+            with transaction.atomic():
+                queryset = self.model.objects.filter(self.store.query_filter.in_q('pk', ids))
+                deleted = list(queryset.values_list('pk', flat=True))
+                queryset.delete()
+                self.post_destroy_many(deleted, optional_data)
         else:
-            cs = [self.model.objects.get(pk=ids)]
+            if isinstance(ids, list):
+                cs = self.model.objects.filter(pk__in=ids)
+            else:
+                cs = [self.model.objects.get(pk=ids)]
 
-        for c in cs:
-            i = c.id
-            c.delete()
-            self.post_destroy(i, optional_data)
+            for c in cs:
+                i = c.id
+                c.delete()
+                self.post_destroy(i, optional_data)
+        bump_model_version_on_commit(self.model)
 
         return {self.store.success: True,
                 self.store.message: self.destroy_success_msg,
@@ -426,10 +692,11 @@ class ExtDirectCRUDComplex(ExtDirectCRUD):
     # the `extdirect` serializer handles them.
     # also treat date formats
     def _fk_fields_parser(self, data):
+        model_fields = self._model_fields()
         for field in data.keys():
             v = data[field]
-            if field in self.model._meta.get_all_field_names():
-                f = self.model._meta.get_field(field)
+            f = model_fields.get(field)
+            if f is not None:
                 if isinstance(f, fields.DateTimeField) \
                         or isinstance(f, fields.DateField) \
                         or isinstance(f, fields.TimeField):
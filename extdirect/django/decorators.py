@@ -1,13 +1,14 @@
 from extdirect.django.crud import ExtDirectCRUD
 
 
-def remoting(provider, action=None, name=None, length=0, form_handler=False, login_required=False, permission=None):
+def remoting(provider, action=None, name=None, length=0, form_handler=False, login_required=False, permission=None,
+             parallel=True):
     """
     Decorator to register a function for a given `action` and `provider`.
     `provider` must be an instance of ExtRemotingProvider
     """    
     def decorator(func):        
-        provider.register(func, action, name, length, form_handler, login_required, permission)
+        provider.register(func, action, name, length, form_handler, login_required, permission, parallel)
         return func
         
     return decorator
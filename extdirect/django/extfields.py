@@ -1,5 +1,6 @@
 import datetime
 from django import forms
+from extdirect.django.identity import related_pks
 #
 # ExtJs Field models
 #
@@ -378,28 +379,28 @@ class ForeignKey(Field):
         conf.update({'type': 'string'})
         return [conf, conf_id]
 
-    def parseValue(self, value):
+    def parseValue(self, value, identity_map=None):
         if value:
-            value = self.parseFK(self.field.rel.to, value)[0]
+            value = self.parseFK(self.field.rel.to, value, identity_map)[0]
         if not value:
             value = None
         return value
 
-    def parseFK(self, cls, value):
-        """ Translates FK or M2M values to instance list """
+    def parseFK(self, cls, value, identity_map=None):
+        """ Translates FK or M2M values to instance list.
+        With an `identity_map` all of them are read with one query. """
+
+        ids = related_pks(value)
+        if identity_map is None:
+            return [cls.objects.get(pk=id) for id in ids]
 
+        identity_map.add(cls, ids)
         relateds = []
-        if isinstance(value, list):
-            for id in value:
-                if isinstance(id, dict) and 'id' in id:
-                    item = cls.objects.get(pk=id['id'])
-                else:
-                    item = cls.objects.get(pk=id)
-                relateds.append(item)
-        elif isinstance(value, dict) and 'id' in value:
-            relateds.append(cls.objects.get(pk=value['id']))
-        else:
-            relateds.append(cls.objects.get(pk=value))
+        for id in ids:
+            item = identity_map.get(cls, id)
+            if item is None:
+                raise cls.DoesNotExist("%s matching query does not exist." % cls._meta.object_name)
+            relateds.append(item)
         return relateds
 
 OneToOneField = ForeignKey
@@ -427,9 +428,9 @@ class ManyToManyField(ForeignKey):
     RENDERER = 'Ext.django.M2MRenderer'
     TYPE = 'array'
 
-    def parseValue(self, value):
+    def parseValue(self, value, identity_map=None):
         if value:
-            value = self.parseFK(self.field.rel.to, value)
+            value = self.parseFK(self.field.rel.to, value, identity_map)
         return value
 
     def getReaderConfig(self):
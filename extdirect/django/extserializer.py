@@ -1,17 +1,16 @@
 from extdirect.django.serializer import Serializer as extdirectSerializer
+from extdirect.django.codec import dumps
 
-from django.core.serializers.json import DjangoJSONEncoder
 from django.utils.encoding import smart_unicode
 from django.utils import simplejson
 from django.db import models
 
-import re
-import json
-
 
 class Serializer(extdirectSerializer):
     # this serialiser create sub-keys for related fields and adds a
     # __unicode__ key for any model instance
+    object_unicode = True
+
     def handle_fk_field(self, obj, field):
         related = getattr(obj, field.name)
         if related is not None:
@@ -40,42 +39,38 @@ class Serializer(extdirectSerializer):
                 m2m_value = lambda value: smart_unicode(value._get_pk_val(),
                     strings_only=True)
             self._current[field.name] = []
-            for related in getattr(obj, field.name).iterator():
+            for related in getattr(obj, field.name).all():
                 self._current[field.name].append({'id':m2m_value(related),
                     '__unicode__':smart_unicode(related, strings_only=True)})
 
+    def handle_fk_value(self, field, value, related):
+        self._current[field.name] = {
+            'id': related._get_pk_val(),
+            '__unicode__': smart_unicode(related, strings_only=True),
+        }
+
+    def handle_m2m_values(self, field, relateds):
+        if self.use_natural_keys and hasattr(field.rel.to, 'natural_key'):
+            m2m_value = lambda value: value.natural_key()
+        else:
+            m2m_value = lambda value: smart_unicode(value._get_pk_val(),
+                strings_only=True)
+        self._current[field.name] = [{'id': m2m_value(related),
+            '__unicode__': smart_unicode(related, strings_only=True)} for related in relateds]
+
     def start_object(self, obj):
         super(Serializer, self).start_object(obj)
-        if isinstance(obj, models.Model):
+        # exclude '__unicode__' to get rid of it (and to allow the store
+        # to serialize from values)
+        if isinstance(obj, models.Model) and not '__unicode__' in self.exclude_fields:
             self._current['__unicode__'] = smart_unicode( obj )
 
 
 def jsonDump(obj):
-    return json.dumps(obj, cls=DjangoJSONEncoder, ensure_ascii=False, indent=4)
+    return dumps(obj, indent=4)
 
 def jsonDumpStripped(inDict):
-    ''' strip some specials values for ExtJs in the simplejson dump '''
-
-    jsonStr = jsonDump(inDict)
-    rawstr = r'\'(%s)\'\s*:\s*\'(.+)\'' % '|'.join([
-        'renderer',
-        'editor',
-        'hidden',
-        'sortable',
-        'sortInfo',
-        'listeners',
-        'view',
-        'failure',
-        'success',
-        'scope',
-        'fn',
-        'store',
-        'handler',
-        'callback',
-        'function',
-    ])
-    reg = re.compile(rawstr,  re.MULTILINE)
-    newstr = reg.subn('"\\1":\\2', jsonStr)[0]
-  #  newstr = jsonStr
-    return newstr
-
+    ''' pretty-printed dump, kept for the API descriptor and backward compatibility.
+    Use `extdirect.django.codec.RawJS` for the values that must be dumped as
+    JavaScript code (renderers, handlers...) '''
+    return jsonDump(inDict)
@@ -2,9 +2,32 @@ import operator
 import string
 import json
 import sys
+import itertools
+import logging
+import numbers
+import threading
+from collections import OrderedDict
+from django.core.exceptions import ValidationError
+from django.db import connections, router
 from django.db.models import Q
 from django.db.models.fields import FieldDoesNotExist
 
+#maximum number of compiled filters kept by the parsers
+MAX_COMPILED_FILTERS = 256
+
+logger = logging.getLogger('extdirect.django.filter')
+
+
+def _empty(parser, values, optional):
+    return Q()
+
+
+class QueryLimitError(Exception):
+    """
+    The query is over the limits of the parser.
+    """
+    pass
+
 
 class QueryParser:
     """
@@ -21,6 +44,28 @@ class QueryParser:
     
     Value example:
         value: { $or: [ { $or:[ {}, {} ...] }, { $not: {} }, {} ] }
+
+    Every shape of query (the expression without its values) is compiled
+    once to a template that just binds the values of each request. The
+    templates are kept in a LRU cache shared by all the parsers. Subclasses
+    re-implementing `_parse_item`, `_parse_logical` or `_parse_field` are
+    parsed the old way; `_parse_comparision` is still called for every value.
+
+    Before that, the query is simplified by `optimize` (unless
+    `optimize_filters` is False).
+
+    The cost of the queries sent by the clients could be limited with:
+        max_depth    - levels of nested expressions
+        max_terms    - number of comparisions
+        max_in       - number of values of an $in
+        fields       - fields that can be filtered (e.g. ['name', 'fk__name'])
+        lookups      - comparision operators allowed (e.g. ['$exact', '$in'])
+        indexed_only - only filter on indexed columns (db_index, unique,
+                       primary and foreign keys, first column of index_together)
+    A query over the limits raises QueryLimitError before it's parsed.
+
+    The $in with more than `in_chunk_size` values are split to keep them
+    under the limits of the databases (see `in_q`).
     """
     #comparision operators
     _gt = '$gt'
@@ -48,23 +93,369 @@ class QueryParser:
     #django's model
     model = None
 
-    def __init__(self, model):
+    #simplify the queries before parsing them, see `optimize`
+    optimize_filters = True
+
+    #compiled templates, see `compile`
+    _compiled = OrderedDict()
+    _compiled_lock = threading.Lock()
+
+    #lookups that could end a field path, see `check_property`
+    lookup_names = set(['exact', 'iexact', 'contains', 'icontains', 'gt', 'gte', 'lt', 'lte', 'in',
+                        'startswith', 'istartswith', 'endswith', 'iendswith', 'range', 'isnull',
+                        'year', 'month', 'day', 'week_day', 'search', 'regex', 'iregex'])
+
+    def __init__(self, model, max_depth=None, max_terms=None, max_in=None, fields=None,
+                 lookups=None, indexed_only=False, in_chunk_size=500):
         self.model = model
+        self.in_chunk_size = in_chunk_size
+        self.max_depth = max_depth
+        self.max_terms = max_terms
+        self.max_in = max_in
+        self.fields = fields
+        self.lookups = lookups
+        self.indexed_only = indexed_only
+        self._indexed = {}
 
     def parse(self, data, optional=None):
         """
-        Deserializes json string to python object and parses it.
+        Deserializes json string to python object (unless it's
+        already decoded) and parses it.
         Returns Q-object.
         """
         result = Q()
         try:
-            data = json.loads(data)
-            result = self._parse_item(data, optional)
+            if isinstance(data, basestring):
+                data = json.loads(data)
+            self.check(data)
+            if self._can_compile():
+                if self.optimize_filters:
+                    data = self.optimize(data)
+                values = []
+                shape = self._shape(data, values)
+                result = self.compile(shape)(self, values, optional)
+            else:
+                result = self._parse_item(data, optional)
         except ValueError as e:
             print(e)
 
         return result
 
+    def check(self, data):
+        """
+        Raises QueryLimitError if the query is over the limits.
+        """
+        terms = 0
+        stack = [(data, 1)]
+        while stack:
+            item, depth = stack.pop()
+            if not isinstance(item, dict) or not len(item):
+                continue
+            if self.max_depth is not None and depth > self.max_depth:
+                raise QueryLimitError("The filter is nested too deep (max. %d levels)" % self.max_depth)
+
+            key = list(item.keys())[0]
+            value = item[key]
+            if key[0] == '$':
+                if isinstance(value, list):
+                    stack.extend((child, depth + 1) for child in value)
+                else:
+                    stack.append((value, depth + 1))
+                continue
+
+            terms += 1
+            if self.max_terms is not None and terms > self.max_terms:
+                raise QueryLimitError("The filter has too many terms (max. %d)" % self.max_terms)
+            if isinstance(value, dict) and len(value):
+                op = list(value.keys())[0]
+                value = value[op]
+            else:
+                op = self._iexact
+            if op == self._in and self.max_in is not None and isinstance(value, (list, tuple)) \
+                    and len(value) > self.max_in:
+                raise QueryLimitError("Too many values for %s (max. %d)" % (key, self.max_in))
+            self.check_lookup(key, op)
+
+    def check_lookup(self, field, op):
+        """
+        Raises QueryLimitError if filtering `field` with the
+        comparision operator `op` is not allowed.
+        """
+        if self.lookups is not None and not op in self.lookups:
+            raise QueryLimitError("The filter operator %s is not allowed" % op)
+        if self.fields is not None and not field in self.fields:
+            raise QueryLimitError("Filtering by %s is not allowed" % field)
+        if self.indexed_only and not self.is_indexed(field):
+            raise QueryLimitError("Filtering by %s is not allowed (not indexed)" % field)
+
+    def check_property(self, prop):
+        """
+        Same as `check_lookup` for a Django lookup, e.g. 'name__icontains'.
+        """
+        parts = prop.split('__')
+        op = '$exact'
+        if len(parts) > 1 and parts[-1] in self.lookup_names:
+            op = '$' + parts.pop()
+        self.check_lookup('__'.join(parts), op)
+
+    def is_indexed(self, path):
+        """
+        Returns True if the column of the field `path` is indexed.
+        """
+        if not path in self._indexed:
+            model = self.model
+            field = None
+            for name in path.split('__'):
+                if field is not None:
+                    if field.rel is None:
+                        raise QueryLimitError("Unknown field %s" % path)
+                    model = field.rel.to
+                try:
+                    field = model._meta.get_field(name)
+                except FieldDoesNotExist:
+                    raise QueryLimitError("Unknown field %s" % path)
+            self._indexed[path] = field.db_index or field.unique or field.primary_key \
+                or any(fields[0] == field.name for fields in model._meta.index_together)
+        return self._indexed[path]
+
+    def _can_compile(self):
+        cls = self.__class__
+        for name in ('_parse_item', '_parse_logical', '_parse_field'):
+            if getattr(cls, name) != getattr(QueryParser, name):
+                return False
+        return True
+
+    def optimize(self, data):
+        """
+        Returns an equivalent and simpler query:
+            - nested $and/$or are flattened and single-term ones unwrapped
+            - duplicated terms are removed
+            - $not: { $not: {...} } becomes {...}
+            - the equality terms on the same field of an $or are merged
+              into an $in, unless `_parse_comparision` is re-implemented
+            - empty branches are removed, and a term matching nothing
+              ($in: []) removes the $or branch or replaces the $and
+        """
+        result = self._optimize(data)
+        if result is None:
+            result = {}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Filter optimized from %d to %d nodes",
+                         self._count_nodes(data), self._count_nodes(result))
+        return result
+
+    def _count_nodes(self, data):
+        if not isinstance(data, dict) or not len(data):
+            return 0
+        key = list(data.keys())[0]
+        if key == self._not:
+            return 1 + self._count_nodes(data[key])
+        if key in (self._and, self._or) and isinstance(data[key], list):
+            return 1 + sum(self._count_nodes(item) for item in data[key])
+        return 1
+
+    def _optimize(self, data):
+        """
+        Returns the optimized filter item or None if it's empty.
+        """
+        if not isinstance(data, dict) or not len(data):
+            return None
+        key = list(data.keys())[0]
+        if key[0] != '$':
+            return {key: data[key]}
+
+        if key == self._not:
+            inner = self._optimize(data[key])
+            if inner is None:
+                return None
+            if list(inner.keys())[0] == self._not:
+                return inner[self._not]
+            return {key: inner}
+
+        if not key in (self._and, self._or) or not isinstance(data[key], list):
+            #left to the parser
+            return data
+
+        children = []
+        seen = set()
+        for item in data[key]:
+            item = self._optimize(item)
+            if item is None:
+                continue
+            if list(item.keys())[0] == key and isinstance(item[key], list):
+                items = item[key]
+            else:
+                items = [item]
+            for child in items:
+                identity = json.dumps(child, sort_keys=True, default=repr)
+                if not identity in seen:
+                    seen.add(identity)
+                    children.append(child)
+
+        if key == self._or and self._can_merge():
+            children = self._merge_equalities(children)
+
+        nothing = [c for c in children if self._matches_nothing(c)]
+        if nothing:
+            if key == self._and:
+                return nothing[0]
+            if len(nothing) < len(children):
+                children = [c for c in children if not self._matches_nothing(c)]
+
+        if not children:
+            return None
+        if len(children) == 1:
+            return children[0]
+        return {key: children}
+
+    def _can_merge(self):
+        return getattr(self.__class__, '_parse_comparision') == getattr(QueryParser, '_parse_comparision')
+
+    def _matches_nothing(self, item):
+        key = list(item.keys())[0]
+        value = item[key]
+        return key[0] != '$' and isinstance(value, dict) and list(value.keys())[0] == self._in \
+            and value[self._in] == []
+
+    def _equality_values(self, item):
+        """
+        Returns the (field, values) of an equality term that can be
+        merged into an $in, otherwise None.
+        """
+        def scalar(value, strings=True):
+            if isinstance(value, basestring):
+                return strings
+            return isinstance(value, numbers.Number)
+
+        field = list(item.keys())[0]
+        if field[0] == '$':
+            return None
+        value = item[field]
+        if not isinstance(value, dict):
+            #implicit $iexact, same as $exact but for strings
+            return (field, [value]) if scalar(value, False) else None
+        op = list(value.keys())[0]
+        value = value[op]
+        if op == self._exact and scalar(value):
+            return field, [value]
+        if op == self._iexact and scalar(value, False):
+            return field, [value]
+        if op == self._in and isinstance(value, list) and all(scalar(v) for v in value):
+            return field, value
+        return None
+
+    def _merge_equalities(self, children):
+        """
+        Merges the equality terms on the same field into an $in.
+        """
+        groups = OrderedDict()
+        result = []
+        for child in children:
+            term = self._equality_values(child)
+            if term is None:
+                result.append(child)
+                continue
+            field, values = term
+            if not field in groups:
+                groups[field] = []
+                result.append((field,))
+            groups[field].append((child, values))
+
+        merged = []
+        for child in result:
+            if isinstance(child, dict):
+                merged.append(child)
+                continue
+            terms = groups[child[0]]
+            if len(terms) == 1:
+                merged.append(terms[0][0])
+                continue
+            values = []
+            seen = set()
+            for term, term_values in terms:
+                for value in term_values:
+                    if not value in seen:
+                        seen.add(value)
+                        values.append(value)
+            merged.append({child[0]: {self._in: values}})
+        return merged
+
+    def _shape(self, data, values):
+        """
+        Returns the shape of the filter item, a tuple that has
+        everything but the values, which are appended to `values`.
+        """
+        if not isinstance(data, dict) or not len(data):
+            return ('',)
+        key = list(data.keys())[0]
+        if key[0] == '$':
+            if not key in self.logical:
+                raise ValueError("Unsupported logical operation %s" % key)
+            if key == self._not:
+                return (key, self._shape(data[key], values))
+            if not isinstance(data[key], list):
+                logger.debug("%s operand is not a list, ignored", key)
+                return ('',)
+            return (key, tuple(self._shape(item, values) for item in data[key]))
+        value = data[key]
+        if isinstance(value, dict):
+            op = list(value.keys())[0]
+            values.append(value[op])
+            return (key, op)
+        values.append(value)
+        return (key, None)
+
+    def compile(self, shape):
+        """
+        Returns the template of a filter shape: a function that takes the
+        parser, the list of values and the optional data and returns the
+        Q-object. Same as `_parse_item` does, but without walking the
+        expression every time.
+        """
+        key = (self.__class__, self.model, shape)
+        with self._compiled_lock:
+            template = self._compiled.pop(key, None)
+            if template is None:
+                template = self._compile(shape, itertools.count()) or _empty
+                if len(self._compiled) >= MAX_COMPILED_FILTERS:
+                    self._compiled.popitem(last=False)
+            self._compiled[key] = template
+        return template
+
+    def _compile(self, shape, slots):
+        """
+        Returns the function that builds the Q-object of `shape`,
+        or None if it's always empty.
+        """
+        key = shape[0]
+        if key == '':
+            return None
+
+        if key == self._not:
+            inner = self._compile(shape[1], slots)
+            if inner is None:
+                return None
+            return lambda parser, values, optional: ~inner(parser, values, optional)
+
+        if key in (self._and, self._or):
+            children = [c for c in (self._compile(item, slots) for item in shape[1]) if c is not None]
+            if not children:
+                return None
+            join = operator.and_ if key == self._and else operator.or_
+            return lambda parser, values, optional: reduce(join, [c(parser, values, optional) for c in children])
+
+        field, op = shape
+        index = next(slots)
+        if op is None:
+            lookup = field + '__' + self._iexact[1:]
+            return lambda parser, values, optional: Q((lookup, values[index]))
+        if op == self._in:
+            return lambda parser, values, optional: \
+                parser.in_q(field, parser._parse_comparision(field, op, values[index], optional))
+        lookup = field + '__' + op[1:]
+        return lambda parser, values, optional: \
+            Q((lookup, parser._parse_comparision(field, op, values[index], optional)))
+
     def _parse_item(self, data, optional):
         """
         Parses filter item: { element: expression }
@@ -136,6 +527,99 @@ class QueryParser:
         if isinstance(value, dict):
             key = value.keys()[0]
             value = self._parse_comparision(field, key, value[key], optional)
+            if key == self._in:
+                return self.in_q(field, value)
             return Q((field + '__' + key[1:], value))
         else:
-            return Q((field + '__' + self._iexact[1:], value))
\ No newline at end of file
+            return Q((field + '__' + self._iexact[1:], value))
+
+    def in_q(self, field, values):
+        """
+        Returns the Q-object of `field` $in `values`.
+
+        Above `in_chunk_size` values, the integers of a local field or
+        foreign key (numeric strings included, they are converted by the
+        field) are written in the SQL as literals, in a subquery on the
+        primary key, so there is no query parameter for them. The column
+        isn't qualified by its table, so it's the one of the subquery
+        (Django renames its table) and the subquery isn't correlated. For other
+        values (strings, fk__name...), the primary keys of the matching
+        objects are looked up first, `in_chunk_size` values per query,
+        and written as literals instead. Only the models with a
+        non-integer primary key still get several IN joined with OR.
+        """
+        size = self.in_chunk_size
+        if not size or not isinstance(values, (list, tuple)) or len(values) <= size:
+            return Q((field + '__in', values))
+
+        column, f = self._literal_column(field)
+        ints = self._integers(f, values) if column is not None else None
+        if ints is None:
+            column, f = self._literal_column('pk')
+            #the base manager doesn't filter out any object
+            manager = self.model._base_manager
+            pks = set()
+            for i in range(0, len(values), size):
+                pks.update(manager.filter(**{field + '__in': values[i:i + size]})
+                                  .values_list('pk', flat=True))
+            pks = sorted(pks)
+            ints = self._integers(f, pks) if column is not None else None
+            if ints is None:
+                return reduce(operator.or_, [Q(pk__in=pks[i:i + size])
+                                             for i in range(0, len(pks), size)])
+        if not ints:
+            return Q(pk__in=[])
+
+        where = '%s IN (%s)' % (column, ','.join('%d' % v for v in ints))
+        return Q(pk__in=self.model._base_manager.extra(where=[where]).values('pk'))
+
+    def _integers(self, field, values):
+        """
+        Returns the `values` converted by `field` if they are all
+        integers, or None.
+        """
+        res = []
+        for value in values:
+            try:
+                v = field.get_prep_value(field.to_python(value))
+            except (TypeError, ValueError, ValidationError):
+                return None
+            if not isinstance(v, numbers.Integral) or isinstance(v, bool):
+                return None
+            if isinstance(value, numbers.Number) and v != value:
+                #1.5 isn't 1
+                return None
+            res.append(v)
+        return res
+
+    def _literal_column(self, field):
+        """
+        Returns the quoted column (without its table) of a local field, or
+        of the foreign key of a `fk__id` path, and the field giving the
+        type of its values.
+        Returns (None, None) for the other fields.
+        """
+        opts = self.model._meta
+        parts = field.split('__')
+        if len(parts) > 2:
+            return None, None
+        if parts[0] == 'pk':
+            f = opts.pk
+        else:
+            try:
+                f = opts.get_field(parts[0])
+            except FieldDoesNotExist:
+                return None, None
+        if not f in opts.local_fields:
+            #many to many or inherited field
+            return None, None
+        target = f
+        if f.rel is not None:
+            #the column holds the values of the related field
+            target = f.rel.get_related_field()
+            if len(parts) == 2 and not parts[1] in ('pk', target.name):
+                return None, None
+        elif len(parts) == 2:
+            return None, None
+        qn = connections[router.db_for_read(self.model)].ops.quote_name
+        return qn(f.column), target
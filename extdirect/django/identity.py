@@ -0,0 +1,164 @@
+"""
+Identity map for the related objects of the CRUD writes.
+
+The foreign keys and many-to-many values of all the records sent in a
+call are collected first (`IdentityMap.add`), then read with one
+`in_bulk` per related model the first time one of them is needed
+(`IdentityMap.get`). The form fields made by `formfield_callback` use
+the map given to them by `bind` instead of one query per value, and the
+foreign keys they resolve aren't checked again by the model validation.
+"""
+from django import forms
+from django.core.exceptions import ValidationError
+from django.db import models
+
+#maximum number of primary keys read by each in_bulk
+CHUNK_SIZE = 500
+
+
+def related_pks(value):
+    """
+    Return the list of primary keys of a FK or M2M value sent by the
+    client: a pk, a record {id: pk}, or a list of them.
+    """
+    if isinstance(value, dict):
+        value = [value]
+    elif not isinstance(value, (list, tuple)):
+        return [value]
+    return [v['id'] if isinstance(v, dict) and 'id' in v else v for v in value]
+
+
+class IdentityMap(object):
+    """
+    The related objects of a call, by model and primary key.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.pending = {}
+
+    def key(self, model, pk):
+        try:
+            return model._meta.pk.to_python(pk)
+        except (ValidationError, TypeError, ValueError):
+            return None
+
+    def add(self, model, pks):
+        """
+        Register the `pks` of `model` to read with the next `get`.
+        """
+        objects = self.objects.setdefault(model, {})
+        pending = self.pending.setdefault(model, set())
+        for pk in pks:
+            pk = self.key(model, pk)
+            if pk is not None and pk not in objects:
+                pending.add(pk)
+
+    def get(self, model, pk):
+        """
+        Return the instance of `model` with `pk`, or None if there isn't any.
+        """
+        pk = self.key(model, pk)
+        if pk is None:
+            return None
+        objects = self.objects.setdefault(model, {})
+        if pk not in objects:
+            self.add(model, [pk])
+            self.load(model)
+        return objects.get(pk)
+
+    def load(self, model):
+        objects = self.objects.setdefault(model, {})
+        pks = list(self.pending.pop(model, ()))
+        for i in range(0, len(pks), CHUNK_SIZE):
+            chunk = pks[i:i + CHUNK_SIZE]
+            found = model._default_manager.in_bulk(chunk)
+            for pk in chunk:
+                #the missing ones are kept too, so they aren't read again
+                objects[pk] = found.get(pk)
+
+
+def mapped(field):
+    #The map is only used for the choices by primary key (ForeignKey.formfield
+    #sets `to_field_name` to the related field) that aren't restricted
+    #(e.g. by `limit_choices_to`).
+    return field.identity_map is not None and not field.queryset.query.where \
+        and field.to_field_name in (None, '', field.queryset.model._meta.pk.name)
+
+
+class ModelChoiceField(forms.ModelChoiceField):
+    identity_map = None
+    #the last value was read from the identity map
+    from_identity_map = False
+
+    def to_python(self, value):
+        self.from_identity_map = False
+        if value not in self.empty_values and mapped(self):
+            obj = self.identity_map.get(self.queryset.model, value)
+            if obj is not None:
+                self.from_identity_map = True
+                return obj
+        return super(ModelChoiceField, self).to_python(value)
+
+
+class ModelMultipleChoiceField(forms.ModelMultipleChoiceField):
+    identity_map = None
+
+    def clean(self, value):
+        if not value or not isinstance(value, (list, tuple)) or not mapped(self):
+            return super(ModelMultipleChoiceField, self).clean(value)
+        objects = []
+        for pk in value:
+            obj = self.identity_map.get(self.queryset.model, pk)
+            if obj is None:
+                #the default validation gives the error
+                return super(ModelMultipleChoiceField, self).clean(value)
+            objects.append(obj)
+        self.run_validators(value)
+        return objects
+
+
+def formfield_callback(db_field, **kwargs):
+    """
+    `formfield_callback` of the CRUD model forms: the related fields
+    can use an identity map.
+    """
+    if isinstance(db_field, models.ManyToManyField):
+        kwargs.setdefault('form_class', ModelMultipleChoiceField)
+    elif isinstance(db_field, models.ForeignKey):
+        kwargs.setdefault('form_class', ModelChoiceField)
+    return db_field.formfield(**kwargs)
+
+
+def bind(form, identity_map):
+    """
+    Make the related fields of `form` read their objects from `identity_map`.
+    """
+    if identity_map is None:
+        return
+    for field in form.fields.values():
+        if isinstance(field, (ModelChoiceField, ModelMultipleChoiceField)):
+            field.identity_map = identity_map
+
+    #ForeignKey.validate would read again each object found in the map:
+    #they are left out of the model validation, not of the uniqueness checks
+    exclusions = form._get_validation_exclusions
+    post_clean = form._post_clean
+
+    def _get_validation_exclusions():
+        exclude = exclusions()
+        for name, field in form.fields.items():
+            if getattr(field, 'from_identity_map', False) and name not in exclude:
+                exclude.append(name)
+        return exclude
+
+    def _post_clean():
+        validate_unique, form._validate_unique = form._validate_unique, False
+        form._get_validation_exclusions = _get_validation_exclusions
+        try:
+            post_clean()
+        finally:
+            del form._get_validation_exclusions
+        if validate_unique:
+            form.validate_unique()
+    form._post_clean = _post_clean
@@ -0,0 +1,128 @@
+import base64
+import json
+import threading
+from collections import OrderedDict
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+
+from extdirect.django import caching
+from extdirect.django.codec import dumps
+
+
+class ExtDirectLookup(object):
+    """
+    Remote lookup for the combos (djangocombo) of the related models.
+
+    Registers a `lookup` method in the action of the model. It returns
+    the `limit` first objects whose `display_field` starts with the
+    `query` text, ordered by that field, and a `nextCursor` to get the
+    next ones (keyset paging). The results are kept in a LRU cache of
+    `cache_size` entries until an instance of the model is saved or
+    deleted.
+
+    The records are {id: pk, __unicode__: display_field}, like the ones
+    read by Ext.django.ComboBox. `display_field` is required: it's the
+    only field of the model published by the lookup.
+    """
+    model = None
+    display_field = None
+
+    #Defaults
+    limit = 20
+    max_limit = 100
+    cache_size = 256
+
+    #paramNames
+    query_param = 'query'
+    limit_param = 'limit'
+    cursor_param = 'cursor'
+
+    def __init__(self, provider, action, model=None, display_field=None,
+                 login_required=False, permission=None):
+        self.model = model or self.model
+        self.display_field = display_field or self.display_field
+        if not self.display_field:
+            raise ImproperlyConfigured('%s lookup needs a display_field' % self.model.__name__)
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        caching.watch_model(self.model)
+        self.register_actions(provider, action, login_required, permission)
+
+    def register_actions(self, provider, action, login_required, permission):
+        provider.register(self.lookup, action, 'lookup', 1, False, login_required, permission)
+
+    def get_queryset(self, request):
+        #You can override this method to restrict the objects.
+        return self.model._default_manager.all()
+
+    def lookup(self, request):
+        data = request.extdirect_post_data[0] or {}
+        text = data.get(self.query_param) or ''
+        try:
+            limit = min(int(data.get(self.limit_param) or self.limit), self.max_limit)
+        except (TypeError, ValueError):
+            limit = self.limit
+        cursor = data.get(self.cursor_param)
+
+        key = (caching.model_version(self.model), text, limit, cursor, self.cache_scope(request))
+        with self._cache_lock:
+            res = self._cache.pop(key, None)
+            if res is not None:
+                self._cache[key] = res
+                return res
+
+        res = self.find(request, text, limit, cursor)
+        with self._cache_lock:
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+            self._cache[key] = res
+        return res
+
+    def cache_scope(self, request):
+        #Same as ExtDirectCRUD.cache_scope, anything that changes the
+        #results of `get_queryset`.
+        return None
+
+    def find(self, request, text, limit, cursor):
+        display = self.display_field
+        queryset = self.get_queryset(request)
+        if text:
+            queryset = queryset.filter(**{display + '__istartswith': text})
+        value, pk = self.decode_cursor(cursor)
+        if pk is not None:
+            queryset = queryset.filter(Q(**{display + '__gt': value}) | Q(**{display: value, 'pk__gt': pk}))
+
+        rows = list(queryset.order_by(display, 'pk').values_list('pk', display)[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        res = {
+            'success': True,
+            'records': [{'id': pk, '__unicode__': value} for pk, value in rows],
+            'hasMore': has_more,
+            'nextCursor': self.encode_cursor(rows[-1]) if has_more else None,
+            'metaData': {
+                'root': 'records',
+                'idProperty': 'id',
+                'successProperty': 'success',
+                'fields': [{'name': 'id'}, {'name': '__unicode__', 'type': 'string'}]
+            }
+        }
+        return res
+
+    def encode_cursor(self, row):
+        return base64.urlsafe_b64encode(dumps([row[1], row[0]]).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        """
+        Return the (display value, pk) of a cursor, or (None, None)
+        for the first page.
+        """
+        if not cursor:
+            return None, None
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+        except (TypeError, ValueError):
+            return None, None
+        return value, pk
@@ -18,6 +18,12 @@ class ExtDirectStoreModel(models.Model):
     name = models.CharField(verbose_name="name", max_length=35)
 
 
+#A primary key set by the forms, to test the bulk inserts
+class CodeModel(models.Model):
+    code = models.CharField(verbose_name="code", max_length=10, primary_key=True)
+    name = models.CharField(verbose_name="name", max_length=35)
+
+
 #We use this model to test the metadata generator module
 class MetaModel(models.Model):
     
@@ -1,14 +1,28 @@
+import re
 import sys
+import copy
+import hashlib
 import traceback
+import types
 import json
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
 
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, \
+    StreamingHttpResponse
 from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.encoding import smart_str
+from django.utils.text import compress_string
 from django import forms
 
 from extdirect.django import extforms
+from extdirect.django.caching import bump_pending
 from extdirect.django.extserializer import jsonDumpStripped
+from extdirect.django.codec import dumps, iterdumps
 from extdirect.django.crud import ExtDirectCRUDComplex, format_form_errors
+from extdirect.django.lookup import ExtDirectLookup
 
 
 SCRIPT = """
@@ -17,6 +31,10 @@ Ext.onReady(function() {
 });
 """
 
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
+logger = logging.getLogger('extdirect.django.providers')
+
 
 class ExtDirectProvider(object):
     """
@@ -27,6 +45,7 @@ class ExtDirectProvider(object):
         self.type = type
         self.url = url
         self.id = id
+        self._descriptors = {}
 
     @property
     def _config(self):
@@ -76,42 +95,116 @@ class ExtDirectProvider(object):
                 ...
             )
         """
-        config = jsonDumpStripped(self._config)
-        js = SCRIPT % config
+        return self.descriptor_response(request, 'script', self._build_script, 'text/javascript')
+
+    def _build_script(self):
+        return SCRIPT % jsonDumpStripped(self._config)
+
+    def invalidate_descriptor(self):
+        """
+        Drop the cached descriptors. It's called every time
+        the provider's configuration changes.
+        """
+        self._descriptors = {}
 
-        return HttpResponse(js, mimetype='text/javascript')
+    def descriptor_response(self, request, key, build, mimetype):
+        """
+        Return a HttpResponse with the descriptor `key`.
+
+        The body is built by calling `build` only the first time (and again
+        after `invalidate_descriptor`), together with its ETag and a gzipped
+        copy. Requests with a matching `If-None-Match` header get a 304.
+        """
+        descriptor = self._descriptors.get(key)
+        if descriptor is None:
+            body = smart_str(build())
+            etag = hashlib.md5(body).hexdigest()
+            descriptor = {
+                'body': body,
+                'etag': '"%s"' % etag,
+                'gzip_body': compress_string(body),
+                'gzip_etag': '"%s-gzip"' % etag,
+            }
+            self._descriptors[key] = descriptor
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            #proxies may turn our tags into weak ones
+            etags = [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]
+            if '*' in etags or descriptor['etag'] in etags or descriptor['gzip_etag'] in etags:
+                response = HttpResponseNotModified()
+                response['ETag'] = descriptor['etag']
+                return response
+
+        if ACCEPTS_GZIP.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            response = HttpResponse(descriptor['gzip_body'], mimetype=mimetype)
+            response['Content-Encoding'] = 'gzip'
+            response['ETag'] = descriptor['gzip_etag']
+        else:
+            response = HttpResponse(descriptor['body'], mimetype=mimetype)
+            response['ETag'] = descriptor['etag']
+
+        response['Vary'] = 'Accept-Encoding'
+        return response
 
 
 class ExtRemotingProvider(ExtDirectProvider):
     """
     ExtDirect RemotingProvider implementation
+
+    If `parallel` is True, the calls of a batched request are run
+    concurrently in a pool of at most `max_workers` threads (one pool
+    per provider). Methods registered with `parallel=False` are always
+    run in the request thread, and a batch with any of them is run there
+    entirely, in the order the calls were received.
+
+    If `atomic_batch` is True, a batched request is run in one database
+    transaction, committed at the end, and every call gets its own
+    savepoint. A call that raises an exception is rolled back alone and
+    gets an `exception` response, the others go on. The calls of these
+    batches are never run in parallel.
     """
 
     type = 'remoting'
 
-    def __init__(self, namespace, url, id=None, descriptor='Descriptor'):
+    def __init__(self, namespace, url, id=None, descriptor='Descriptor',
+                 parallel=False, max_workers=4, atomic_batch=False):
         super(ExtRemotingProvider, self).__init__(url, self.type, id)
 
         self.namespace = namespace
         self.actions = {}
         self.descriptor = descriptor
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.atomic_batch = atomic_batch
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
-    def api(self, request):
-        conf = self._config
-        descriptor = self.namespace + '.' + self.descriptor
+    @property
+    def actions(self):
+        return self._actions
 
+    @actions.setter
+    def actions(self, actions):
+        self._actions = actions
+        self.invalidate_descriptor()
+
+    def api(self, request):
         if 'format' in request.GET and request.GET['format'] == 'json':
-            conf['descriptor'] = descriptor
-            mimetype = 'application/json'
-            response = jsonDumpStripped(conf)
+            return self.descriptor_response(request, 'api-json', self._build_api_json, 'application/json')
         else:
-            response = """
+            return self.descriptor_response(request, 'api-js', self._build_api_js, 'text/javascript')
+
+    def _build_api_json(self):
+        conf = self._config
+        conf['descriptor'] = self.namespace + '.' + self.descriptor
+        return jsonDumpStripped(conf)
+
+    def _build_api_js(self):
+        return """
 Ext.ns('%s');
 %s = %s
-""" % (self.namespace, descriptor, jsonDumpStripped(self._config))
-            mimetype = 'text/javascript'
-
-        return HttpResponse(response, mimetype=mimetype)
+""" % (self.namespace, self.namespace + '.' + self.descriptor, jsonDumpStripped(self._config))
 
     @property
     def _config(self):
@@ -134,23 +227,45 @@ Ext.ns('%s');
 
         return config
 
-    def registerCRUD(self, cls,  action=None, app=None):
+    def registerCRUD(self, cls,  action=None, app=None, lookups=None,
+                     login_required=False, permission=None):
         # register CRUD actions for specified cls model
         # the default ExtDirect action will be 'app_label_model_name'
+        # `lookups` maps the related models to the display field of their
+        # `lookup` method (see registerLookup), with the same login_required
+        # and permission as the CRUD actions
 
         class CrudItem(ExtDirectCRUDComplex):
             model = cls
             provider = self
 
-        item = CrudItem()
-
         if not app:
             app = cls._meta.app_label
         if not action:
             action = '%s_%s' % (app, cls.__name__)
-        item.register_actions(self, action, False, None)
+
+        # the constructor registers the actions without restrictions
+        item = CrudItem(self, action, cls)
+        if login_required or permission:
+            item.register_actions(self, action, login_required, permission)
+
+        for model, display_field in (lookups or {}).items():
+            self.registerLookup(model, display_field=display_field,
+                                login_required=login_required, permission=permission)
         return item
 
+    def registerLookup(self, cls, action=None, app=None, display_field=None,
+                       login_required=False, permission=None):
+        # register the `lookup` action for specified cls model (see ExtDirectLookup),
+        # unless it's already registered. Only `display_field` is published.
+        if not app:
+            app = cls._meta.app_label
+        if not action:
+            action = '%s_%s' % (app, cls.__name__)
+        if 'lookup' in self.actions.get(action, {}):
+            return None
+        return ExtDirectLookup(self, action, cls, display_field, login_required, permission)
+
     def registerForm(self, formCls,  action=None, name=None, success=None):
         # register submit action for forms
         if not action:
@@ -184,7 +299,7 @@ Ext.ns('%s');
         self.register(submit, action=action, name='submit', length=0, form_handler=True)
 
     def register(self, method, action=None, name=None, length=0, form_handler=False,
-                 login_required=False, permission=None):
+                 login_required=False, permission=None, parallel=True):
 
         if not action:
             action = method.__module__.replace('.', '_')
@@ -199,7 +314,9 @@ Ext.ns('%s');
                                           len=length,
                                           form_handler=form_handler,
                                           login_required=login_required,
-                                          permission=permission)
+                                          permission=permission,
+                                          parallel=parallel)
+        self.invalidate_descriptor()
 
     def dispatcher(self, request, extdirect_req):
         """
@@ -277,6 +394,73 @@ Ext.ns('%s');
 
         return response
 
+    def batch_dispatcher(self, request, extdirect_reqs):
+        """
+        Call the dispatcher for every ExtDirect request of a batch.
+
+        In parallel mode the calls are sent to the provider's thread pool,
+        unless one of them isn't registered as parallel (e.g. a write): then
+        the batch is run here in order. Either way, the responses are
+        returned in the same order the calls were recieved.
+        """
+        if self.atomic_batch and len(extdirect_reqs) > 1:
+            with transaction.atomic():
+                responses = [self._atomic_dispatcher(request, r) for r in extdirect_reqs]
+            #the cache versions of the models written by the batch
+            bump_pending()
+            return responses
+
+        if not self.parallel or len(extdirect_reqs) < 2 \
+                or not all(self._can_run_parallel(r) for r in extdirect_reqs):
+            return [self.dispatcher(request, r) for r in extdirect_reqs]
+
+        pool = self._get_pool()
+        #every thread gets its own copy of the request because the
+        #dispatcher sets the `extdirect_post_data` attribute on it.
+        pending = [pool.apply_async(self._threaded_dispatcher, (copy.copy(request), r))
+                   for r in extdirect_reqs]
+        return [result.get() for result in pending]
+
+    def _atomic_dispatcher(self, request, extdirect_req):
+        #Runs a call of an `atomic_batch` in its own savepoint.
+        try:
+            with transaction.atomic():
+                return self.dispatcher(request, extdirect_req)
+        except Exception:
+            logger.exception("Call %s.%s of an atomic batch failed",
+                             extdirect_req.get('action'), extdirect_req.get('method'))
+            etype, evalue, etb = sys.exc_info()
+            response = dict((k, v) for k, v in extdirect_req.items() if k != 'data')
+            response['type'] = 'exception'
+            if settings.DEBUG:
+                response['message'] = traceback.format_exception_only(etype, evalue)[0]
+                response['where'] = traceback.extract_tb(etb)[-1]
+            else:
+                response['message'] = 'Server error'
+            return response
+
+    def _can_run_parallel(self, extdirect_req):
+        try:
+            info = self.actions[extdirect_req['action']][extdirect_req['method']]
+        except (KeyError, TypeError):
+            #let the dispatcher report it from the request thread
+            return False
+        return info.get('parallel', True)
+
+    def _threaded_dispatcher(self, request, extdirect_req):
+        try:
+            return self.dispatcher(request, extdirect_req)
+        finally:
+            #worker threads have their own database connections
+            close_old_connections()
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.max_workers)
+        return self._pool
+
     def router(self, request):
         """
         Check if the request came from a Form POST and call
@@ -301,9 +485,7 @@ Ext.ns('%s');
 
         if isinstance(extdirect_request, list):
             #call in batch
-            response = []
-            for single_request in extdirect_request:
-                response.append(self.dispatcher(request, single_request))
+            response = self.batch_dispatcher(request, extdirect_request)
 
         elif isinstance(extdirect_request, dict):
            #single call
@@ -315,7 +497,11 @@ Ext.ns('%s');
         else:
             mimetype = 'application/json'
 
-        return HttpResponse(jsonDumpStripped(response), mimetype=mimetype)
+        content = iterdumps(response)
+        if isinstance(content, types.GeneratorType):
+            #the response has streamed results (e.g. ExtDirectStore(stream=True))
+            return StreamingHttpResponse(content, content_type=mimetype)
+        return HttpResponse(content, mimetype=mimetype)
 
 
 class ExtPollingProvider(ExtDirectProvider):
@@ -355,14 +541,14 @@ class ExtPollingProvider(ExtDirectProvider):
                 response['type'] = 'event'
                 response['data'] = 'You must be authenticated to run this method.'
                 response['name'] = self.event
-                return HttpResponse(jsonDumpStripped(response), mimetype='application/json')
+                return HttpResponse(dumps(response), mimetype='application/json')
 
         if self.permission:
             if not request.user.has_perm(self.permission):
                 response['type'] = 'result'
                 response['data'] = 'You need `%s` permission to run this method' % self.permission
                 response['name'] = self.event
-                return HttpResponse(jsonDumpStripped(response), mimetype='application/json')
+                return HttpResponse(dumps(response), mimetype='application/json')
 
         try:
             if self.func:
@@ -381,4 +567,4 @@ class ExtPollingProvider(ExtDirectProvider):
             else:
                 raise e
 
-        return HttpResponse(jsonDumpStripped(response), mimetype='application/json')
+        return HttpResponse(dumps(response), mimetype='application/json')
@@ -0,0 +1,230 @@
+"""
+Search backends for the `query` parameter of ExtDirectStore.
+
+A backend returns the primary keys of the objects matching the text
+typed by the user, which are then filtered, sorted and paged as usual::
+
+    store = ExtDirectStore(Article, search_backend=InvertedIndexBackend,
+                           search_fields=['title', 'body'])
+
+Both built-in backends match the words of the text as prefixes of the
+words in the fields (all of them must match), instead of the substrings
+matched by the default `$icontains` filter.
+"""
+import bisect
+import re
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+from django.db.models.signals import post_save, post_delete
+
+from extdirect.django import caching
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+
+
+def words(text):
+    return [w.lower() for w in WORDS.findall(text)]
+
+
+class SearchBackend(object):
+    """
+    Base class for the search backends.
+    """
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = fields
+
+    def search(self, text):
+        """
+        Return the primary keys of the objects matching `text`,
+        or None if all of them match (e.g. no words).
+        """
+        raise NotImplementedError
+
+    def update(self, pks):
+        """
+        Called when the objects with `pks` were written without sending
+        signals (e.g. bulk writes of the CRUD actions).
+        """
+        pass
+
+    def remove(self, pks):
+        """
+        Same as `update` for deleted objects.
+        """
+        pass
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    """
+    Search with a SQLite FTS5 table, created (and filled) the first
+    time it's needed. It's kept up to date by triggers, so it sees
+    every write, even the ones made without the ORM. The model must
+    have an integer primary key.
+    """
+
+    def __init__(self, model, fields):
+        super(SQLiteFTS5Backend, self).__init__(model, fields)
+        self.table = '%s_fts' % model._meta.db_table
+        self.ready = False
+        self.lock = threading.Lock()
+
+    def connection(self):
+        connection = connections[router.db_for_read(self.model)]
+        if connection.vendor != 'sqlite':
+            raise ImproperlyConfigured("SQLiteFTS5Backend needs a SQLite database")
+        return connection
+
+    def setup(self):
+        connection = self.connection()
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [self.table])
+        if cursor.fetchone():
+            return
+
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table, fts, pk = qn(opts.db_table), qn(self.table), qn(opts.pk.column)
+        columns = [qn(opts.get_field(name).column) for name in self.fields]
+
+        def values(prefix):
+            return ', '.join(['%s.%s' % (prefix, pk)] + ['%s.%s' % (prefix, c) for c in columns])
+
+        names = ', '.join(['rowid'] + columns)
+        insert = "INSERT INTO %s(%s) VALUES (%s);" % (fts, names, values('new'))
+        delete = "INSERT INTO %s(%s, %s) VALUES ('delete', %s);" % (fts, fts, names, values('old'))
+
+        cursor.execute("CREATE VIRTUAL TABLE %s USING fts5(%s, content=%s, content_rowid=%s)"
+                       % (fts, ', '.join(columns), table, pk))
+        cursor.execute("CREATE TRIGGER %s AFTER INSERT ON %s BEGIN %s END"
+                       % (qn(self.table + '_ai'), table, insert))
+        cursor.execute("CREATE TRIGGER %s AFTER DELETE ON %s BEGIN %s END"
+                       % (qn(self.table + '_ad'), table, delete))
+        cursor.execute("CREATE TRIGGER %s AFTER UPDATE ON %s BEGIN %s %s END"
+                       % (qn(self.table + '_au'), table, delete, insert))
+        cursor.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (fts, fts))
+
+    def search(self, text):
+        terms = words(text)
+        if not terms:
+            return None
+        if not self.ready:
+            with self.lock:
+                if not self.ready:
+                    self.setup()
+                    self.ready = True
+
+        connection = self.connection()
+        fts = connection.ops.quote_name(self.table)
+        cursor = connection.cursor()
+        cursor.execute("SELECT rowid FROM %s WHERE %s MATCH %%s" % (fts, fts),
+                       [' '.join('"%s"*' % term for term in terms)])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class InvertedIndexBackend(SearchBackend):
+    """
+    Search with an inverted index kept in memory, built the first time
+    it's needed and updated when the objects are saved or deleted.
+
+    Every process has its own index, with a version counter (see
+    `caching`) bumped only by the backends. An index is rebuilt when the
+    counter was bumped by another process, so the cache must be shared
+    by all of them. The stores of a model searching the same fields
+    should share one backend instance, or each one rebuilds after the
+    writes seen by the other.
+    """
+
+    def __init__(self, model, fields):
+        super(InvertedIndexBackend, self).__init__(model, fields)
+        self.lock = threading.RLock()
+        self.index = None
+        self.version = None
+        self.version_name = 'search:%s:%s' % (caching.model_label(model), ','.join(fields))
+        uid = 'extdirect-search-%s-%s' % (caching.model_label(model), id(self))
+        post_save.connect(self._saved, sender=model, weak=False, dispatch_uid=uid)
+        post_delete.connect(self._deleted, sender=model, weak=False, dispatch_uid=uid)
+
+    def build(self):
+        self.index = {}
+        self.documents = {}
+        #sorted at the end
+        self.words = None
+        self.version = caching.version(self.version_name)
+        rows = self.model._base_manager.values_list('pk', *self.fields)
+        for row in rows.iterator():
+            self._add(row[0], row[1:])
+        self.words = sorted(self.index)
+
+    def _add(self, pk, values):
+        document = set()
+        for value in values:
+            if value is not None:
+                document.update(words(u'%s' % value))
+        self.documents[pk] = document
+        for word in document:
+            if not word in self.index:
+                self.index[word] = set()
+                if self.words is not None:
+                    bisect.insort(self.words, word)
+            self.index[word].add(pk)
+
+    def _remove(self, pk):
+        for word in self.documents.pop(pk, ()):
+            pks = self.index[word]
+            pks.discard(pk)
+            if not pks:
+                del self.index[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+
+    def search(self, text):
+        terms = words(text)
+        if not terms:
+            return None
+        with self.lock:
+            if self.index is None or self.version != caching.version(self.version_name):
+                self.build()
+            result = None
+            for term in terms:
+                pks = set()
+                i = bisect.bisect_left(self.words, term)
+                while i < len(self.words) and self.words[i].startswith(term):
+                    pks.update(self.index[self.words[i]])
+                    i += 1
+                result = pks if result is None else result & pks
+                if not result:
+                    break
+            return list(result)
+
+    def update(self, pks):
+        with self.lock:
+            if self.index is not None:
+                for row in self.model._base_manager.filter(pk__in=pks).values_list('pk', *self.fields):
+                    self._remove(row[0])
+                    self._add(row[0], row[1:])
+            #the other processes must see the write, even without an index here
+            self._bump()
+
+    def remove(self, pks):
+        with self.lock:
+            if self.index is not None:
+                for pk in pks:
+                    self._remove(pk)
+            self._bump()
+
+    def _bump(self):
+        #Up to date only if no other process wrote since the last version
+        version = caching.bump_version(self.version_name)
+        if self.version is not None and version == self.version + 1:
+            self.version = version
+        else:
+            self.version = None
+
+    def _saved(self, sender, instance, **kw):
+        self.update([instance.pk])
+
+    def _deleted(self, sender, instance, **kw):
+        self.remove([instance.pk])
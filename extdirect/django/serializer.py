@@ -1,14 +1,63 @@
 from django.core.serializers import python
 from django.utils.encoding import smart_unicode
 from io import StringIO
+from itertools import islice
+
+#maximum number of values in the IN clause used to fetch related objects
+RELATED_CHUNK_SIZE = 500
+
+#maximum number of compiled plans kept by the serializers
+MAX_PLANS = 512
+
+
+def related_objects(model, field_name, values):
+    """
+    Return a dict {value: instance} with the instances of `model`
+    whose `field_name` is in `values`.
+    """
+    values = list(set(v for v in values if v is not None))
+    objects = {}
+    for i in range(0, len(values), RELATED_CHUNK_SIZE):
+        chunk = values[i:i + RELATED_CHUNK_SIZE]
+        for obj in model._default_manager.filter(**{field_name + '__in': chunk}):
+            objects[getattr(obj, field_name)] = obj
+    return objects
+
+
+def iterator(queryset, chunk_size):
+    """
+    Return `queryset.iterator()`, reading `chunk_size` rows per fetch
+    when the Django version supports it.
+    """
+    try:
+        return queryset.iterator(chunk_size=chunk_size)
+    except TypeError:
+        return queryset.iterator()
+
+
+def chunks(iterable, size):
+    iterable = iter(iterable)
+    chunk = list(islice(iterable, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterable, size))
 
 
 class Serializer(python.Serializer):
 
+    #True if every record has the `__unicode__` of its object,
+    #which may use any of the object's fields.
+    object_unicode = False
+
+    #compiled plans shared by all the serializers, see `get_plan`
+    _plans = {}
+
     def start_serialization(self, total):
         self._current = None
         self.objects = {self.meta['root']: [], self.meta['total']: total,
                         self.meta['success']: True}
+        self._root = self.objects[self.meta['root']]
+        self._id_property = self.meta['idProperty']
 
     def end_serialization(self, total, single_cast):
         if total == 1 and single_cast:
@@ -20,12 +69,12 @@ class Serializer(python.Serializer):
 
     def end_object(self, obj):
         rec = self._current
-        rec[self.meta['idProperty']] = smart_unicode(obj._get_pk_val(), strings_only=True)
+        rec[self._id_property] = smart_unicode(obj._get_pk_val(), strings_only=True)
 
         for extra in self.extras:
             rec[extra[0]] = extra[1](obj)
 
-        self.objects[self.meta['root']].append(rec)
+        self._root.append(rec)
         self._current = None
 
     def handle_field(self, obj, field):
@@ -60,7 +109,8 @@ class Serializer(python.Serializer):
             list_ids = []
             list_val = []
 
-            for related in getattr(obj, field.name).iterator():
+            #all() uses the objects prefetched by the store, if any
+            for related in getattr(obj, field.name).all():
                 list_ids.append(m2m_value(related))
                 list_val.append(related.__unicode__())
 
@@ -69,10 +119,32 @@ class Serializer(python.Serializer):
         else:
             self.handle_m2m_field_through(obj, field)
 
-    def serialize(self, queryset, **options):
+    def handle_fk_value(self, field, value, related):
         """
-        Serializes queryset.
+        Same as `handle_fk_field` for the values path: `value` is the
+        content of the foreign key column and `related` the object.
+        """
+        if field.rel.field_name == related._meta.pk.name:
+            self._current[field.name + '_id'] = smart_unicode(value, strings_only=True)
+            self._current[field.name] = smart_unicode(related, strings_only=True)
+        else:
+            self._current[field.name] = smart_unicode(value, strings_only=True)
+            self._current[field.name + '_id'] = self._current[field.name]
+
+    def handle_m2m_values(self, field, relateds):
         """
+        Same as `handle_m2m_field` for the values path: `relateds`
+        is the list of related objects.
+        """
+        if self.use_natural_keys and hasattr(field.rel.to, 'natural_key'):
+            m2m_value = lambda value: value.natural_key()
+        else:
+            m2m_value = lambda value: smart_unicode(value._get_pk_val(), strings_only=True)
+
+        self._current[field.name + '_ids'] = [m2m_value(related) for related in relateds]
+        self._current[field.name] = [related.__unicode__() for related in relateds]
+
+    def setup(self, queryset, options):
         self.options = options
         self.stream = options.get('stream', StringIO())
         self.selected_fields = options.get('fields')
@@ -82,38 +154,200 @@ class Serializer(python.Serializer):
         self.meta = options.get('meta', dict(root='records', total='total', success='success', idProperty='id'))
         self.extras = options.get('extras', [])
 
+        if 'total' in options:
+            return options['total']
+        return queryset.count()
+
+    def get_plan(self, model, values=False):
+        """
+        Return the compiled plan to serialize the objects of `model` with
+        the current options (see `compile_plan` and `compile_values_plan`).
+
+        Plans are cached per serializer class, model, selected fields,
+        excluded fields and `local` option, and reused across requests.
+        """
+        selected = self.selected_fields
+        if selected is not None:
+            selected = tuple(selected)
+        key = (self.__class__, model, values, bool(self.local_fields), selected, tuple(self.exclude_fields))
+
+        plan = self._plans.get(key)
+        if plan is None:
+            if values:
+                plan = self.compile_values_plan(model)
+            else:
+                plan = self.compile_plan(model)
+            if len(self._plans) >= MAX_PLANS:
+                self._plans.clear()
+            self._plans[key] = plan
+        return plan
+
+    def compile_plan(self, model):
+        """
+        Return the list of (handler, field) to call for every object
+        of `model`, e.g. (Serializer.handle_field, <field: name>).
+        """
+        cls = self.__class__
+        selected = self.selected_fields
+
+        if self.local_fields:
+            fields = model._meta.local_fields
+        else:
+            fields = model._meta.fields
+
+        plan = []
+        for field in fields:
+            if not field.serialize or field.name in self.exclude_fields:
+                continue
+            if field.rel is None:
+                if selected is None or field.attname in selected:
+                    plan.append((cls.handle_field, field))
+            else:
+                if selected is None or field.attname[:-3] in selected:
+                    plan.append((cls.handle_fk_field, field))
+
+        for field in model._meta.many_to_many:
+            if field.serialize:
+                if selected is None or field.attname in selected:
+                    plan.append((cls.handle_m2m_field, field))
+
+        return plan
+
+    def compile_values_plan(self, model):
+        """
+        Return the (columns, fields, m2m fields) used by `serialize_values`.
+        `columns` starts with the primary key, followed by one column for
+        each field.
+        """
+        selected = self.selected_fields
+        opts = model._meta
+
+        fields = [f for f in opts.fields if f.serialize and f.name not in self.exclude_fields
+                  and (selected is None or f.name in selected)]
+        m2m_fields = [f for f in opts.many_to_many if f.serialize and f.rel.through._meta.auto_created
+                      and (selected is None or f.name in selected)]
+        columns = [opts.pk.attname] + [f.attname for f in fields]
+
+        return columns, fields, m2m_fields
+
+    def serialize_values(self, queryset, rows=None, **options):
+        """
+        Serializes queryset from `values_list()` tuples, without building
+        the model instances. The records are the same as `serialize` ones,
+        but `extras` and `local` are not supported and the objects' fields
+        must not need any conversion (no custom fields).
+
+        The related objects are fetched with one query per relation
+        (`related_objects`). If `rows` is given, these tuples are used
+        instead of reading the queryset (see `iter_serialize`).
+        """
+        total = self.setup(queryset, options)
         single_cast = options.get('single_cast', False)
-        total = options.get('total', queryset.count())
+        columns, fields, m2m_fields = self.get_plan(queryset.model, values=True)
+
+        if rows is None:
+            rows = list(queryset.prefetch_related(None).values_list(*columns))
+
+        relateds = {}
+        for i, field in enumerate(fields):
+            if field.rel is not None:
+                relateds[field.name] = related_objects(field.rel.to, field.rel.field_name,
+                                                       [row[i + 1] for row in rows])
+
+        m2m = {}
+        pks = [row[0] for row in rows]
+        for field in m2m_fields:
+            m2m[field.name] = self.m2m_objects(field, pks)
 
         self.start_serialization(total)
+        root = self._root
+        id_property = self._id_property
+        indexed = [(i + 1, field, field.name, relateds.get(field.name)) for i, field in enumerate(fields)]
 
-        for obj in queryset:
-            if self.local_fields:
-                fields = obj._meta.local_fields
-            else:
-                fields = obj._meta.fields
+        for row in rows:
+            self._current = current = {}
+            for i, field, name, related_map in indexed:
+                value = row[i]
+                if related_map is None:
+                    current[name] = smart_unicode(value, strings_only=True)
+                elif value is not None:
+                    related = related_map.get(value)
+                    if related is not None:
+                        self.handle_fk_value(field, value, related)
 
-            fields = [f for f in fields if f.name not in self.exclude_fields]
-            self.start_object(obj)
+            for field in m2m_fields:
+                self.handle_m2m_values(field, m2m[field.name].get(row[0], []))
+
+            current[id_property] = smart_unicode(row[0], strings_only=True)
+            root.append(current)
+        self._current = None
+
+        self.end_serialization(total, single_cast)
+        return self.getvalue()
+
+    def m2m_objects(self, field, pks):
+        """
+        Return a dict {pk: [related objects]} for the many-to-many `field`
+        of the objects with the given `pks`.
+        """
+        through = field.rel.through
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
 
-            for field in fields:
-                if field.serialize:
-                    if field.rel is None:
-                        if self.selected_fields is None or field.attname \
-                                in self.selected_fields:
-                            self.handle_field(obj, field)
-                    else:
-                        if self.selected_fields is None or field.attname[:-3] \
-                                in self.selected_fields:
-                            self.handle_fk_field(obj, field)
-
-            for field in obj._meta.many_to_many:
-                if field.serialize:
-                    if self.selected_fields is None or field.attname \
-                            in self.selected_fields:
-                        self.handle_m2m_field(obj, field)
+        links = []
+        for i in range(0, len(pks), RELATED_CHUNK_SIZE):
+            links.extend(through._default_manager.filter(**{source + '__in': pks[i:i + RELATED_CHUNK_SIZE]})
+                         .order_by('pk').values_list(source, target))
 
+        targets = related_objects(field.rel.to, field.rel.to._meta.pk.name, [t for s, t in links])
+        objects = {}
+        for source_pk, target_pk in links:
+            if target_pk in targets:
+                objects.setdefault(source_pk, []).append(targets[target_pk])
+        return objects
+
+    def serialize(self, queryset, **options):
+        """
+        Serializes queryset.
+        """
+        total = self.setup(queryset, options)
+        single_cast = options.get('single_cast', False)
+
+        self.start_serialization(total)
+
+        model = plan = None
+        for obj in queryset:
+            if obj.__class__ is not model:
+                model = obj.__class__
+                plan = self.get_plan(model)
+
+            self.start_object(obj)
+            for handler, field in plan:
+                handler(self, obj, field)
             self.end_object(obj)
+
         self.end_serialization(total, single_cast)
         return self.getvalue()
 
+    def iter_serialize(self, queryset, chunk_size, values=False, **options):
+        """
+        Serializes queryset `chunk_size` objects at a time and yields
+        the list of records of every chunk, so only one chunk is kept
+        in memory. With `values` the chunks are serialized from
+        `values_list()` tuples, like `serialize_values` does.
+
+        `prefetch_related` lookups are ignored by `iterator()`, use
+        `values` to read the many-to-many fields with one query per chunk.
+        """
+        options = dict(options, total=0)
+        if values:
+            self.setup(queryset, options)
+            columns = self.get_plan(queryset.model, values=True)[0]
+            source = iterator(queryset.prefetch_related(None).values_list(*columns), chunk_size)
+            serialize = lambda chunk: self.serialize_values(queryset, rows=chunk, **options)
+        else:
+            source = iterator(queryset, chunk_size)
+            serialize = lambda chunk: self.serialize(chunk, **options)
+
+        for chunk in chunks(source, chunk_size):
+            yield serialize(chunk)[self.meta['root']]
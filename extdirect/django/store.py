@@ -1,23 +1,127 @@
-from django.core.serializers import serialize
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.db import models
-from django.db.models import Q
+from django.core.serializers import get_serializer
+from django.db import models, connections
+from django.db.models import Q, Sum, Avg, Min, Max, Count
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.core.cache import cache
 
-from extdirect.django.filter import QueryParser
+from extdirect.django import caching
+from extdirect.django.codec import dumps, JSONStream
+from extdirect.django.filter import QueryParser, QueryLimitError
 from extdirect.django.metadata import meta_fields, meta_columns
 
+import base64
+import hashlib
+import json
 import operator
 
+#summary types of the `summary` parameter
+AGGREGATES = {'sum': Sum, 'avg': Avg, 'min': Min, 'max': Max, 'count': Count}
+
 
 class ExtDirectStore(object):
     """
     Implement the server-side needed to load an Ext.data.DirectStore
+
+    With `keyset=True` the pages are not fetched with OFFSET but from
+    an opaque `cursor` sent back by the client (see `keyset_page`).
+    In that mode, `count_total=False` skips the COUNT query.
+
+    `count_strategy` tells how the total of a paged read is computed:
+
+        'exact'     - a COUNT query every time (the default).
+        'cached'    - the COUNT is cached for `count_timeout` seconds, per
+                      filter. Saving or deleting an instance of the model
+                      invalidates it (but not the writes to other models
+                      used in the filter).
+        'estimated' - the COUNT is limited to `count_threshold` + 1 rows.
+                      Above that the total is estimated (see `estimate_count`)
+                      and the result has `totalEstimated: true`.
+
+    It could also be a function that takes the queryset and returns the total.
+
+    The related objects needed by the serializer are fetched along with the
+    objects: `select_related` for the foreign keys and `prefetch_related` for
+    the many-to-many fields. Both are planned from the serialized fields when
+    they are `None`; give a list of names to choose them, or `False` to
+    disable them.
+
+    When the client asks for some `fields` only, the other columns are not
+    loaded (`only()`). By default (`projection=None`) this is done unless
+    the store has `extras` or the serializer adds the objects' `__unicode__`,
+    since they may use any field. Use `projection_include` to always load
+    some fields, `projection=True` to force it and `False` to disable it.
+
+    For the same reasons, the store serializes from `values_list()` tuples,
+    without building the model instances, when it doesn't have `extras`,
+    the serializer doesn't add the objects' `__unicode__` (or it's in the
+    `exclude_fields`) and the model has only standard Django fields. Set
+    `values_path=False` to always use the model instances.
+
+    With `stream=True` the records are read `chunk_size` at a time, with
+    one keyset query per chunk (see `keyset_chunks`), and written to the
+    response as they come, so big reads (exports, unpaged reads) never
+    have the whole result in memory. The total is counted
+    first, with `count_strategy`. Needs a provider that streams the
+    responses, like ExtRemotingProvider.
+
+    With `record_format='array'` the records are lists instead of dicts,
+    with the keys sent once in `fields_header`. The `metaData` (when the
+    store has `metadata=True`) maps every field to its position and has
+    `recordFormat: 'array'`, which makes the reader of Ext.django.Store
+    read the arrays. It's meant for read-only grids (the JsonWriter uses
+    the mappings as keys) and it's ignored for streamed reads.
+
+    With `cache_results=True` the results of `query` are cached for
+    `cache_timeout` seconds. The key is made of the model version (bumped
+    when an instance is saved or deleted and by the CRUD actions), the
+    request parameters, the given queryset and `cache_scope` (anything that
+    changes the result and isn't in the parameters, like the user). Every
+    result has a `version`; when the client sends it back and the data
+    didn't change, the reply is just {success: true, notModified: true}.
+    As with the cached counts, writes to other models are not tracked.
+
+    The filters sent by the clients could be limited with `max_filter_depth`,
+    `max_filter_terms`, `max_in_size`, `filter_fields`, `filter_lookups` and
+    `indexed_filters_only` (see QueryParser). A read over the limits is
+    rejected before running any SQL, with a failure result and the reason
+    in the `message`. The `query` search only uses the allowed fields.
+    The filters with huge $in lists are rewritten to respect the limits of
+    the database, above `in_chunk_size` values (see `QueryParser.in_q`).
+
+    The `query` parameter (quick search) looks for the text in the
+    `search_fields` (by default all but the primary and foreign keys) with
+    `$icontains`, or with a `search_backend` (a class or an instance, see
+    the `search` module), whose primary keys go through the filters,
+    sorting and paging as usual.
+
+    The clients could also ask for aggregates computed by the database
+    over all the filtered objects, returned next to the page of records:
+
+        groupBy: ['field', ...], groupDir: 'ASC'  --> groups: [{field: value, ...,
+                                                      column: value, groupCount: n}]
+        summary: {column: 'sum'}                  --> summary: {column: value}
+
+    The summary types are sum, avg, min, max and count; the summaries are
+    computed for every group too. At most `max_groups` groups are returned.
     """
     def __init__(self, model, extras=[], root='records', total='total', success='success',
                  message='message', start='start', limit='limit', sort='sort', dir='direction',
                  prop='property', id_property='id', filter='filter', pquery='query',
                  metadata=False, mappings={}, sort_info={}, custom_meta={}, fields=[],
-                 exclude_fields=[], extra_fields=[], get_metadata=None):
+                 exclude_fields=[], extra_fields=[], get_metadata=None, keyset=False,
+                 cursor='cursor', next_cursor='nextCursor', prev_cursor='prevCursor',
+                 has_more='hasMore', count_total=True, count_strategy='exact', count_timeout=60,
+                 count_threshold=10000, total_estimated='totalEstimated', select_related=None,
+                 prefetch_related=None, projection=None, projection_include=[], values_path=True,
+                 stream=False, chunk_size=1000, record_format='object', fields_header='fields',
+                 cache_results=False, cache_timeout=300, version='version', not_modified='notModified',
+                 max_filter_depth=None, max_filter_terms=None, max_in_size=None, filter_fields=None,
+                 filter_lookups=None, indexed_filters_only=False, in_chunk_size=500,
+                 search_backend=None, search_fields=None, group='groupBy', group_dir='groupDir',
+                 summary='summary', groups_root='groups', summary_root='summary',
+                 group_count='groupCount', max_groups=1000):
         
         self.model = model        
         self.root = root
@@ -46,7 +150,58 @@ class ExtDirectStore(object):
         self.metadata = {}
         self.queryfilter = 'queryfilter'
         self.value = 'value'
-        self.query_filter = QueryParser(self.model)
+        self.query_filter = QueryParser(self.model, max_depth=max_filter_depth,
+                                        max_terms=max_filter_terms, max_in=max_in_size,
+                                        fields=filter_fields, lookups=filter_lookups,
+                                        indexed_only=indexed_filters_only,
+                                        in_chunk_size=in_chunk_size)
+        # quick search
+        self.search_fields = search_fields
+        if isinstance(search_backend, type):
+            search_backend = search_backend(model, self.searchable_fields())
+        self.search_backend = search_backend
+        # grouping and summaries
+        self.group = group
+        self.group_dir = group_dir
+        self.summary = summary
+        self.groups_root = groups_root
+        self.summary_root = summary_root
+        self.group_count = group_count
+        self.max_groups = max_groups
+        # keyset pagination
+        self.keyset = keyset
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.has_more = has_more
+        self.count_total = count_total
+        # total counts
+        self.count_strategy = count_strategy
+        self.count_timeout = count_timeout
+        self.count_threshold = count_threshold
+        self.total_estimated = total_estimated
+        if count_strategy == 'cached':
+            caching.watch_model(model)
+        # related objects
+        self.select_related = select_related
+        self.prefetch_related = prefetch_related
+        # column projection
+        self.projection = projection
+        self.projection_include = projection_include
+        self.values_path = values_path
+        # streaming
+        self.stream = stream
+        self.chunk_size = chunk_size
+        # record format
+        self.record_format = record_format
+        self.fields_header = fields_header
+        # result cache
+        self.cache_results = cache_results
+        self.cache_timeout = cache_timeout
+        self.version = version
+        self.not_modified = not_modified
+        if cache_results:
+            caching.watch_model(model)
         
     def build_meta_data(self, optional=None):
 
@@ -70,15 +225,56 @@ class ExtDirectStore(object):
            
             self.metadata.update(self.custom_meta)  
 
-    def query(self, qs=None, metadata=True, col_model=False, fields=None, optional=None, **kw):
+    def query(self, qs=None, metadata=True, col_model=False, fields=None, optional=None,
+              cache_scope=None, **kw):
         """
         Filter objects and return serialized bundle.
+        The results are cached when the store has `cache_results`.
+        """
+        if not self.cache_results or self.stream:
+            return self.run_query(qs, metadata, col_model, fields, optional, **kw)
+
+        client_version = kw.pop(self.version, None)
+        key = self.cache_key(qs, metadata, col_model, fields, optional, cache_scope, kw)
+        version = hashlib.md5(key.encode('utf-8')).hexdigest()
+        if client_version == version:
+            return {self.success: True, self.not_modified: True, self.version: version}
+
+        res = cache.get(key)
+        if res is None:
+            res = self.run_query(qs, metadata, col_model, fields, optional, **kw)
+            if res.get(self.success):
+                cache.set(key, res, self.cache_timeout)
+        res[self.version] = version
+        return res
+
+    def cache_key(self, qs, metadata, col_model, fields, optional, scope, kw):
+        if qs is None:
+            source = None
+        elif hasattr(qs, 'all'):
+            try:
+                source = str(qs.all().query)
+            except EmptyResultSet:
+                source = ''
+        else:
+            source = repr(qs)
+        config = [self.root, self.total, self.id_property, self.fields, self.exclude_fields,
+                  [extra[0] for extra in self.extras], self.record_format]
+        return caching.make_key('query', self.model, config, kw, metadata, col_model, fields,
+                                source, repr(optional), scope)
+
+    def run_query(self, qs=None, metadata=True, col_model=False, fields=None, optional=None, **kw):
+        """
+        Filter objects and return serialized bundle, without the cache.
         """
         paginate = False
         sort_field = 'id'
         sort_dir = 'DESC'
 
-        kw, qfilters = self.filter_handler(optional=optional, **kw)
+        try:
+            kw, qfilters = self.filter_handler(optional=optional, **kw)
+        except QueryLimitError as e:
+            return {self.success: False, self.root: [], self.total: 0, self.message: str(e)}
 
         if self.start in kw and self.limit in kw:
             start = kw.pop(self.start)
@@ -105,39 +301,456 @@ class ExtDirectStore(object):
         else:
             queryset = queryset.all()
 
+        try:
+            summaries = self.summaries(queryset, kw.pop(self.group, None), kw.pop(self.group_dir, 'ASC'),
+                                       kw.pop(self.summary, None))
+        except QueryLimitError as e:
+            return {self.success: False, self.root: [], self.total: 0, self.message: str(e)}
+
+        selected = self.selected_fields(fields)
+        queryset = self.plan_related(queryset, selected)
+        queryset = self.project(queryset, selected, include=[sort_field])
+
+        if self.keyset and paginate and limit:
+            res = self.keyset_page(queryset, kw.pop(self.cursor, None), limit, sort_field, sort_dir,
+                                   metadata, col_model, fields=fields, optional=optional)
+            res.update(summaries)
+            return res
+
+        keyset_order = (sort_field, sort_dir)
         if not sort_field is None:
             if sort_dir == 'DESC':
                 sort_field = '-' + sort_field
             queryset = queryset.order_by(sort_field)
                  
+        estimated = False
         if not paginate or not limit:
             objects = queryset
-            total = queryset.count()
+            total = None
+            if self.stream:
+                total, estimated = self.count(queryset)
         else:
-            paginator = Paginator(queryset, limit)
-            total = paginator.count
-            
-            try:                
-                page = paginator.page(start / limit + 1)
-            except (EmptyPage, InvalidPage):
+            total, estimated = self.count(queryset)
+
+            page = start // limit
+            #an estimated total could be too low
+            if page < 0 or (page and page * limit >= total and not estimated):
                 #out of range, deliver last page of results.
-                page = paginator.page(paginator.num_pages)
-            
-            objects = page.object_list
-            
-        return self.serialize(objects, metadata, col_model, total, fields=fields, optional=optional)
+                page = max(0, (total - 1) // limit)
+
+            objects = queryset[page * limit:(page + 1) * limit]
+
+        if self.stream:
+            res = self.serialize([], metadata, col_model, total, fields=fields, optional=optional)
+            res[self.root] = JSONStream(self.stream_records(objects, fields=fields, optional=optional,
+                                                            order=keyset_order))
+            if estimated:
+                res[self.total_estimated] = True
+            res.update(summaries)
+            return res
+
+        res = self.serialize(objects, metadata, col_model, total, fields=fields, optional=optional)
+        if total is None:
+            #no COUNT query for the unpaged reads
+            res[self.total] = len(res[self.root])
+        if estimated:
+            res[self.total_estimated] = True
+        res.update(summaries)
+        return res
+
+    def summaries(self, queryset, group=None, group_dir='ASC', summary=None):
+        """
+        Return a dict with the aggregates of the `queryset` asked by the
+        client: the groups and the overall summary. It makes one query
+        for each.
+        """
+        if not group and not summary:
+            return {}
+        if isinstance(group, basestring):
+            group = [group]
+        group = group or []
+        summary = summary or {}
+        if not isinstance(group, list) or not isinstance(summary, dict):
+            raise QueryLimitError("Invalid grouping or summary")
+
+        aggregates = {}
+        columns = {}
+        for column, kind in summary.items():
+            self.check_summary_field(column)
+            if not kind in AGGREGATES:
+                raise QueryLimitError("Unknown summary type %s" % kind)
+            #the aliases can't be the names of the fields
+            alias = 'extdirect_summary_%d' % len(aggregates)
+            aggregates[alias] = AGGREGATES[kind](column)
+            columns[alias] = column
+        for name in group:
+            self.check_summary_field(name)
+
+        queryset = queryset.order_by()
+        res = {}
+        if aggregates:
+            totals = queryset.aggregate(**aggregates)
+            res[self.summary_root] = dict((columns[alias], value) for alias, value in totals.items())
+
+        if group:
+            if group_dir == 'DESC':
+                ordering = ['-' + name for name in group]
+            else:
+                ordering = group
+            counted = dict(aggregates, extdirect_group_count=Count('pk'))
+            groups = []
+            for row in queryset.values(*group).annotate(**counted).order_by(*ordering)[:self.max_groups]:
+                item = dict((name, row[name]) for name in group)
+                for alias, column in columns.items():
+                    item[column] = row[alias]
+                item[self.group_count] = row['extdirect_group_count']
+                groups.append(item)
+            res[self.groups_root] = groups
+        return res
+
+    def check_summary_field(self, name):
+        opts = self.model._meta
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            raise QueryLimitError("Unknown field %s" % name)
+        if field in opts.many_to_many:
+            raise QueryLimitError("Can't group or summarize %s" % name)
+        fields = self.query_filter.fields
+        if fields is not None and not name in fields:
+            raise QueryLimitError("Grouping by %s is not allowed" % name)
+
+    def count(self, queryset):
+        """
+        Return the total number of objects in the `queryset` and if it's
+        estimated, according to the `count_strategy`. At most one COUNT
+        query is made.
+        """
+        if callable(self.count_strategy):
+            return self.count_strategy(queryset), False
+
+        if self.count_strategy == 'cached':
+            try:
+                key = caching.make_key('count', self.model, str(queryset.order_by().query))
+            except EmptyResultSet:
+                return 0, False
+            total = cache.get(key)
+            if total is None:
+                total = queryset.count()
+                cache.set(key, total, self.count_timeout)
+            return total, False
+
+        if self.count_strategy == 'estimated':
+            #count() of a sliced queryset counts all the rows
+            total = len(queryset.order_by().values_list('pk', flat=True)[:self.count_threshold + 1])
+            if total <= self.count_threshold:
+                return total, False
+            return max(total, self.estimate_count(queryset)), True
+
+        return queryset.count(), False
+
+    def estimate_count(self, queryset):
+        """
+        Return an estimation of the number of objects in the `queryset`.
+
+        On PostgreSQL it's the number of rows expected by the planner,
+        otherwise it's 0 and the limited count is used instead.
+        """
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return 0
+        try:
+            sql, params = queryset.order_by().query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def keyset_page(self, queryset, cursor, limit, sort_field, sort_dir, metadata=True, col_model=False,
+                    fields=None, optional=None):
+        """
+        Return the page of `limit` objects next to the `cursor`.
+
+        The objects are ordered by (`sort_field`, pk) and the page is fetched
+        with an indexed `WHERE (sort_field, pk) > (value, pk)` instead of an
+        OFFSET (see `keyset_after`), so deep pages are as fast as the first one. One extra row is
+        fetched to know if there are more objects after the page.
+
+        Besides the records, the result has the cursors to fetch the next
+        and previous pages (`None` at the ends) and the `hasMore` flag.
+        The sort field should not be nullable.
+        """
+        if sort_field is None or sort_field == 'pk':
+            sort_field = self.model._meta.pk.name
+        ascending = sort_dir != 'DESC'
+
+        total = None
+        estimated = False
+        if self.count_total:
+            total, estimated = self.count(queryset)
+
+        direction, value, pk = self.decode_cursor(cursor)
+        backwards = direction == 'prev'
+
+        if direction:
+            queryset = self.keyset_after(queryset, sort_field, value, pk, ascending != backwards)
+
+        order = [sort_field, 'pk']
+        if ascending == backwards:
+            order = ['-' + f for f in order]
+        objects = list(queryset.order_by(*order)[:limit + 1])
+
+        more = len(objects) > limit
+        objects = objects[:limit]
+        if backwards:
+            objects.reverse()
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = direction is not None, more
+
+        res = self.serialize(objects, metadata, col_model, total, fields=fields, optional=optional)
+        res[self.next_cursor] = None
+        res[self.prev_cursor] = None
+        if objects:
+            if has_next:
+                res[self.next_cursor] = self.encode_cursor('next', objects[-1], sort_field)
+            if has_prev:
+                res[self.prev_cursor] = self.encode_cursor('prev', objects[0], sort_field)
+        res[self.has_more] = has_next
+        if estimated:
+            res[self.total_estimated] = True
+        return res
+
+    def keyset_after(self, queryset, sort_field, value, pk, greater):
+        """
+        Return the `queryset` filtered to the rows after (or before, if
+        not `greater`) the (`value`, `pk`) position.
+
+        When the sort field is a column of the model and the database
+        compares row values (PostgreSQL, MySQL, SQLite 3.15+), the filter
+        is a single `(sort_field, pk) > (value, pk)` that the planner can
+        use as one index range. Otherwise it's `keyset_filter`.
+        """
+        opts = self.model._meta
+        connection = connections[queryset.db]
+        if sort_field == opts.pk.name or not self.row_values(connection):
+            return queryset.filter(self.keyset_filter(sort_field, value, pk, greater))
+        try:
+            field = opts.get_field(sort_field)
+        except FieldDoesNotExist:
+            field = None
+        if field is None or not field in opts.local_fields:
+            #a path across relations or an inherited field
+            return queryset.filter(self.keyset_filter(sort_field, value, pk, greater))
+
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        where = '(%s.%s, %s.%s) %s (%%s, %%s)' % (table, qn(field.column), table, qn(opts.pk.column),
+                                                 greater and '>' or '<')
+        params = [field.get_db_prep_value(field.to_python(value), connection),
+                  opts.pk.get_db_prep_value(opts.pk.to_python(pk), connection)]
+        return queryset.extra(where=[where], params=params)
+
+    def row_values(self, connection):
+        """
+        Return True if the database of `connection` compares row values.
+        """
+        if connection.vendor in ('postgresql', 'mysql'):
+            return True
+        if connection.vendor == 'sqlite':
+            import sqlite3
+            return sqlite3.sqlite_version_info >= (3, 15, 0)
+        return False
+
+    def keyset_filter(self, sort_field, value, pk, greater):
+        """
+        Return the Q-object selecting the rows after (or before,
+        if not `greater`) the (`value`, `pk`) position, written as
+        `sort > value OR (sort = value AND pk > pk)`.
+        """
+        op = greater and 'gt' or 'lt'
+        if sort_field == self.model._meta.pk.name:
+            return Q(**{'pk__' + op: pk})
+        return Q(**{sort_field + '__' + op: value}) | Q(**{sort_field: value, 'pk__' + op: pk})
+
+    def encode_cursor(self, direction, obj, sort_field):
+        value = obj
+        for name in sort_field.split('__'):
+            value = getattr(value, name)
+        if isinstance(value, models.Model):
+            value = value._get_pk_val()
+        data = dumps([direction, value, obj._get_pk_val()]).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        """
+        Return the (direction, sort value, pk) of a cursor. An empty
+        or invalid cursor is the first page: (None, None, None).
+        """
+        if not cursor:
+            return None, None, None
+        try:
+            direction, value, pk = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+        except (TypeError, ValueError):
+            return None, None, None
+        if not direction in ('next', 'prev'):
+            return None, None, None
+        return direction, value, pk
         
-    def serialize(self, queryset, metadata=True, col_model=False, total=None, fields=None, optional=None):
+    def selected_fields(self, fields):
+        """
+        Return the names of the model fields among the `fields` requested
+        by the client (field names or attnames, like 'fk_id'), or `None`
+        if all the fields must be serialized.
+        """
+        if not fields:
+            return None
+        opts = self.model._meta
+        selected = [f.name for f in list(opts.fields) + list(opts.many_to_many)
+                    if f.name in fields or f.attname in fields]
+        return selected or None
+
+    def project(self, queryset, selected, include=[]):
+        """
+        Load only the `selected` columns (plus the primary key and the
+        `include` fields) of the `queryset`, see `projection`.
+        """
+        if selected is None or self.projection is False:
+            return queryset
+        if self.projection is None and self.needs_objects():
+            return queryset
+
+        opts = self.model._meta
+        wanted = set(selected) | set(include) | set(self.projection_include)
+        names = [opts.pk.name] + [f.name for f in opts.fields if f.name in wanted and not f.primary_key]
+        return queryset.only(*names)
+
+    def needs_objects(self):
+        """
+        Return True if the serialization may use any field of the objects:
+        the store has `extras` or the serializer adds their `__unicode__`.
+        """
+        if self.extras:
+            return True
+        return getattr(get_serializer('extdirect'), 'object_unicode', False) \
+            and not '__unicode__' in self.exclude_fields
+
+    def use_values(self, queryset):
+        """
+        Return True if the `queryset` can be serialized from values.
+        """
+        if not self.values_path or self.needs_objects() or not isinstance(queryset, QuerySet):
+            return False
+        if not hasattr(get_serializer('extdirect'), 'serialize_values'):
+            return False
+        opts = self.model._meta
+        for field in list(opts.fields) + list(opts.many_to_many):
+            if not field.__class__.__module__.startswith('django.db.models'):
+                return False
+        return True
+
+    def plan_related(self, queryset, fields=None):
+        """
+        Apply `select_related` and `prefetch_related` to the `queryset`
+        so serializing the relations doesn't query once per object.
+        """
+        select = self.select_related
+        prefetch = self.prefetch_related
 
+        if select is None or prefetch is None:
+            def serialized(field):
+                return field.serialize and not field.name in self.exclude_fields \
+                    and (fields is None or field.name in fields)
+
+            if select is None:
+                select = [f.name for f in self.model._meta.fields if f.rel and serialized(f)]
+            if prefetch is None:
+                prefetch = [f.name for f in self.model._meta.many_to_many
+                            if f.rel.through._meta.auto_created and serialized(f)]
+
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+    def serializer_options(self, total=None, fields=None, optional=None):
         meta = {
             'root': self.root,
             'total': self.total,
             'success': self.success,
             'idProperty': self.id_property
-        }        
+        }
+        return dict(meta=meta, extras=self.extras, total=total, exclude_fields=self.exclude_fields,
+                    optional=optional, fields=self.selected_fields(fields))
+
+    def stream_records(self, queryset, fields=None, optional=None, order=None):
+        """
+        Yield the JSON array of the serialized `queryset`, in pieces
+        of `chunk_size` records. An unsliced `queryset` is read with
+        `keyset_chunks`, ordered by `order`: (sort field, direction).
+        """
+        options = self.serializer_options(fields=fields, optional=optional)
+        serializer = get_serializer('extdirect')()
+        values = self.use_values(queryset)
+        if queryset.query.low_mark or queryset.query.high_mark is not None:
+            #a page, at most `limit` rows
+            sources = [queryset]
+        else:
+            sources = self.keyset_chunks(queryset, *(order or (None, 'ASC')))
+        separator = '['
+        for source in sources:
+            for records in serializer.iter_serialize(source, self.chunk_size, values=values, **options):
+                if records:
+                    yield separator + dumps(records)[1:-1]
+                    separator = ','
+        yield '[]' if separator == '[' else ']'
+
+    def keyset_chunks(self, queryset, sort_field, sort_dir):
+        """
+        Yield the objects of `queryset` ordered by (`sort_field`, pk) in
+        querysets of at most `chunk_size` objects. The keys of every chunk
+        are read after the last key of the previous one, and the chunk is
+        the range between these two keys, so the database driver never
+        holds more than a chunk: `iterator()` alone loads the whole result
+        (no server-side cursors on Django 1.6).
+
+        The sort field should not be nullable, as for `keyset_page`.
+        """
+        if sort_field is None or sort_field == 'pk':
+            sort_field = self.model._meta.pk.name
+        ascending = sort_dir != 'DESC'
+        order = [sort_field, 'pk']
+        if not ascending:
+            order = ['-' + f for f in order]
+        queryset = queryset.order_by(*order)
 
-        res = serialize('extdirect', queryset, meta=meta, extras=self.extras,
-                        total=total, exclude_fields=self.exclude_fields, optional=optional)
+        last = None
+        while True:
+            chunk = queryset
+            if last is not None:
+                chunk = self.keyset_after(chunk, sort_field, last[0], last[1], ascending)
+            keys = list(chunk.values_list(sort_field, 'pk')[:self.chunk_size])
+            if not keys:
+                return
+            value, pk = keys[-1]
+            yield chunk.exclude(self.keyset_filter(sort_field, value, pk, ascending))
+            if len(keys) < self.chunk_size:
+                return
+            last = value, pk
+
+    def serialize(self, queryset, metadata=True, col_model=False, total=None, fields=None, optional=None):
+
+        options = self.serializer_options(total, fields, optional)
+        serializer = get_serializer('extdirect')()
+        if self.use_values(queryset):
+            res = serializer.serialize_values(queryset, **options)
+        else:
+            res = serializer.serialize(queryset, **options)
 
         self.build_meta_data(optional=optional)
 
@@ -147,9 +760,42 @@ class ExtDirectStore(object):
             # also include columns for grids
             if col_model:
                 res['columns'] = meta_columns(self.model, fields=fields)
-             
+
+        if self.record_format == 'array' and not self.stream:
+            self.to_arrays(res)
+
         return res
 
+    def to_arrays(self, res):
+        """
+        Turn the records of `res` into lists. The header starts with the
+        keys of the `metaData` fields, in the same order, followed by the
+        other keys of the records.
+        """
+        records = res[self.root]
+        fields_meta = self.metadata.get('fields', [])
+
+        header = []
+        seen = set()
+        present = set()
+        for rec in records:
+            present.update(rec)
+        for key in [f.get('mapping', f['name']) for f in fields_meta] + [self.id_property] + sorted(present):
+            if key in present and not key in seen:
+                seen.add(key)
+                header.append(key)
+
+        res[self.root] = [[rec.get(key) for key in header] for rec in records]
+        res[self.fields_header] = header
+
+        if 'metaData' in res:
+            index = dict((key, i) for i, key in enumerate(header))
+            meta = dict(res['metaData'], recordFormat='array', idIndex=index.get(self.id_property))
+            #the fields missing in the records point past the end of the arrays
+            meta['fields'] = [dict(f, mapping=index.get(f.get('mapping', f['name']), len(header)))
+                              for f in fields_meta]
+            res['metaData'] = meta
+
     def filter_handler(self, optional=None, **kw):
         """
         Handles the `filter` and 'query' keys.
@@ -166,15 +812,23 @@ class ExtDirectStore(object):
                             return kw, self.query_filter.parse(item[self.value], optional=optional)
                         else:
                             prop = item[self.property]
+                            self.query_filter.check_property(prop)
                             return kw, Q((prop, item[self.value]))
             elif self.property in f and self.value in f:
                 if f[self.property] == self.queryfilter:
                     return kw, self.query_filter.parse(f[self.value], optional=optional)
                 else:
                     prop = f[self.property]
+                    self.query_filter.check_property(prop)
                     return kw, Q((prop, f[self.value]))
         return kw, Q()
 
+    def searchable_fields(self):
+        if self.search_fields is not None:
+            return self.search_fields
+        return [field.name for field in self.model._meta.fields
+                if field.name != 'id' and not isinstance(field, models.ForeignKey)]
+
     def query_handler(self, optional, **kw):
         """
         Handles the `query` key.
@@ -185,16 +839,26 @@ class ExtDirectStore(object):
         #    kw.pop(self.limit)
         #kw.__setitem__(self.start, 0)
         template = kw.pop(self.pquery)
-        fields = self.model._meta.fields
+
+        if self.search_backend is not None:
+            pks = self.search_backend.search(template)
+            if pks is None:
+                return kw, Q()
+            return kw, self.query_filter.in_q('pk', list(pks))
+
         conditions = []
+        limited = False
 
-        for field in fields:
-            if field.name == 'id':
-                continue
-            if isinstance(field, models.ForeignKey):
+        for name in self.searchable_fields():
+            try:
+                self.query_filter.check_lookup(name, '$icontains')
+            except QueryLimitError:
+                limited = True
                 continue
-            conditions.append('{"%s":{"$icontains": "%s"}}' % (field.name, template))
+            conditions.append({name: {'$icontains': template}})
 
-        expression = '{"$or":[%s]}' % ','.join(conditions)
+        if limited and not conditions:
+            raise QueryLimitError("There are no fields to search")
+        expression = {'$or': conditions}
 
         return kw, self.query_filter.parse(expression, optional=optional)
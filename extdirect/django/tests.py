@@ -55,6 +55,27 @@ def suite():
         setUp=setUp,
         tearDown=tearDown,
         globs=globs))
+
+    suite.addTest(doctest.DocFileSuite(
+        './doctests/store.txt',
+        optionflags=optionflags,
+        setUp=setUp,
+        tearDown=tearDown,
+        globs=globs))
+
+    suite.addTest(doctest.DocFileSuite(
+        './doctests/providers.txt',
+        optionflags=optionflags,
+        setUp=setUp,
+        tearDown=tearDown,
+        globs=globs))
+
+    suite.addTest(doctest.DocFileSuite(
+        './doctests/codec.txt',
+        optionflags=optionflags,
+        setUp=setUp,
+        tearDown=tearDown,
+        globs=globs))
     
     return suite
 
@@ -58,6 +58,26 @@ Ext.django.M2MRenderer = function(obj) {
     return obj;
 };
 
+Ext.django.JsonReader = Ext.extend(Ext.data.JsonReader, {
+    // a json reader that also reads the records sent as arrays
+    // (metaData.recordFormat == 'array', see ExtDirectStore record_format)
+    readRecords: function(o) {
+        if (o.notModified) {
+            // same data as the last load (see ExtDirectStore cache_results)
+            return {success: true, notModified: true, records: [], totalRecords: 0};
+        }
+        var meta = o.metaData || this.meta;
+        if (meta.recordFormat != 'array') {
+            return Ext.django.JsonReader.superclass.readRecords.call(this, o);
+        }
+        this.jsonData = o;
+        if (o.metaData) {
+            this.onMetaChange(o.metaData);
+        }
+        return Ext.data.ArrayReader.prototype.readRecords.call(this, o);
+    }
+});
+
 Ext.django.Store = Ext.extend(Ext.data.DirectStore, {
     // a direct store for django models
     constructor: function(config) {
@@ -74,9 +94,56 @@ Ext.django.Store = Ext.extend(Ext.data.DirectStore, {
             baseParams: baseParams,
             autoLoad: true
         });
+        if (!config.reader) {
+            config.reader = new Ext.django.JsonReader(
+                Ext.copyTo({}, config, 'totalProperty,root,idProperty'), config.fields);
+        }
 
         Ext.django.Store.superclass.constructor.call(this, config );
-     }
+
+        // keyset pagination: remember the cursors sent by the server
+        this.on('load', function(store) {
+            var data = store.reader.jsonData || {};
+            store.nextCursor = data.nextCursor || null;
+            store.prevCursor = data.prevCursor || null;
+            store.hasMore = !!data.hasMore;
+            store.dataVersion = data.version || null;
+        });
+
+        // cached stores: send the version of the data we already have
+        this.on('beforeload', function(store, options) {
+            if (store.dataVersion) {
+                options.params[store.versionParam] = store.dataVersion;
+            }
+        });
+     },
+
+    versionParam: 'version',
+
+    loadRecords: function(o, options, success) {
+        if (o && o.notModified && success !== false) {
+            // the server didn't resend the records, keep the current ones
+            var records = this.getRange();
+            this.fireEvent('load', this, records, options);
+            if (options.callback) {
+                options.callback.call(options.scope || this, records, options, true);
+            }
+            return;
+        }
+        return Ext.django.Store.superclass.loadRecords.apply(this, arguments);
+    },
+
+    loadNext: function(options) {
+        // load the page after the current one (keyset stores)
+        if (!this.nextCursor) return false;
+        return this.load(Ext.apply({params: {cursor: this.nextCursor}}, options));
+    },
+
+    loadPrevious: function(options) {
+        // load the page before the current one (keyset stores)
+        if (!this.prevCursor) return false;
+        return this.load(Ext.apply({params: {cursor: this.prevCursor}}, options));
+    }
 });
 
 Ext.django.IndexStore = Ext.extend(Ext.django.Store, {
@@ -89,34 +156,38 @@ Ext.django.IndexStore = Ext.extend(Ext.django.Store, {
 
 Ext.django.ComboBox = Ext.extend(Ext.ux.AwesomeCombo, {
     // direct model AwesomeCombo
+    // uses the `lookup` method of the model (remote prefix search, see ExtDirectLookup)
+    // if it's registered, otherwise loads the whole model with `read`
     constructor: function(config) {
         var pageSize = config.pageSize || 0;
         var baseParams = {};
         var model = config.model.replace('.', '_');
+        var remote = !!django[model].lookup;
         var config = Ext.applyIf(config, {
             valueField: 'id',
             displayField: '__unicode__',
             triggerAction: 'all',
             format: 'object',
-            pageSize: pageSize,
+            pageSize: remote ? 0 : pageSize,
             store: new Ext.django.IndexStore({
                 api: {
-                    read: django[model].read
+                    read: remote ? django[model].lookup : django[model].read
                 },
+                autoLoad: !remote,
                 baseParams: {
                     start: 0,
-                    limit: pageSize
+                    limit: remote ? (config.lookupLimit || 20) : pageSize
                 }
             }),
             emptyText: 'choose : ',
             typeAhead: false,
-            mode: 'local',
-            queryParam: 'name__istartswith',
+            mode: remote ? 'remote' : 'local',
+            queryParam: remote ? 'query' : 'name__istartswith',
             queryDelay: 100,
-            minChars: 2,
-            editable: false,
+            minChars: remote ? 1 : 2,
+            editable: remote,
             format: config.enableMultiSelect ? 'array' : 'string',
-            typeAhead: true,
+            typeAhead: !remote,
             disableClearButton: !config.allowBlank,
             hiddenName: config.name
         });